@@ -0,0 +1,4 @@
+"""
+Offline benchmarks, run them from the app directory:
+    python -m benchmarks.pipeline --help
+"""
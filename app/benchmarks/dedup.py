@@ -0,0 +1,261 @@
+"""
+Duplicate detection benchmark: accuracy of the descriptor distance on a labelled corpus and query cost
+as the number of stored spoilers grows.
+
+The corpus is built from random scryfall cards:
+- same card pairs: scryfall render vs a simulated photo of the card (perspective, light, blur, jpeg),
+  and vs real reddit crops from --crops (files named <scryfall_id>*.jpg)
+- different card pairs: render of a card vs simulated photo of another card
+Distances are Bhattacharyya x 100 like SpoilerDetector, a pair is a duplicate when distance < threshold.
+The two stages of SpoilerDetector are also scored: a pair is only compared by histograms when the phash distance
+is under the gate (SpoilerDetector.phash_distance), query latency uses phashes of the corpus cards.
+The bot only uses the gate when SpoilerDetector.phash_gate is set, turn it on once its recall is known.
+
+    python -m benchmarks.dedup --cards 200 --report dedup.md
+"""
+import os
+import random
+import hashlib
+import argparse
+import itertools
+from time import perf_counter
+from types import SimpleNamespace
+import cv2 as cv
+import numpy as np
+import scryfall
+import im_utils
+from spoiler_detector import SpoilerDetector, DescriptorIndex
+
+thresholds = list(range(5, 61, 5)) + [29]
+descriptor_settings = {"8x8x8 illustration": {"bins": (8, 8, 8), "box": im_utils.illustration_box},
+                       "4x4x4 illustration": {"bins": (4, 4, 4), "box": im_utils.illustration_box},
+                       "16x16x16 illustration": {"bins": (16, 16, 16), "box": im_utils.illustration_box},
+                       "8x8x8 whole card": {"bins": (8, 8, 8), "box": (0.5, 0.5, 1, 1)},
+                       "8x8x8 frame aware": {"bins": (8, 8, 8), "box": "frame"}}
+index_sizes = [1000, 10000, 100000]
+phash_gates = [8, 12, 16, 20, 24, 28, 32, 64]
+
+
+def fetch(url, cache_dir):
+    """Read image from url, downloaded once in cache_dir"""
+    filename = os.path.join(cache_dir, hashlib.sha1(url.encode()).hexdigest())
+    if not os.path.isfile(filename):
+        image = im_utils.imread_url(url, flags=cv.IMREAD_COLOR)
+        if image is None:
+            return None
+        cv.imwrite(filename + ".png", image)
+        os.replace(filename + ".png", filename)
+    return cv.imread(filename, cv.IMREAD_COLOR)
+
+
+def simulate_photo(image, rng):
+    """Make a card render look like a reddit photo or screenshot of the card"""
+    h, w = image.shape[:2]
+    d = 0.06
+    src = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+    dst = src + np.float32([[rng.uniform(-d, d) * w, rng.uniform(-d, d) * h] for _ in range(4)])
+    photo = cv.warpPerspective(image, cv.getPerspectiveTransform(src, dst), (w, h), borderMode=cv.BORDER_REPLICATE)
+    photo = cv.convertScaleAbs(photo, alpha=rng.uniform(0.8, 1.2), beta=rng.uniform(-25, 25))
+    photo = cv.GaussianBlur(photo, (3, 3), rng.uniform(0.1, 1.5))
+    scale = rng.uniform(0.5, 1.0)
+    photo = cv.resize(photo, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+    ok, buffer = cv.imencode(".jpg", photo, [cv.IMWRITE_JPEG_QUALITY, rng.randint(40, 90)])
+    return cv.imdecode(buffer, cv.IMREAD_COLOR)
+
+
+def build_corpus(card_count, cache_dir, crops_dir=None, seed=0):
+    """
+    :return: list of tuple (image_a, image_b, is_same_card, kind)
+    """
+    rng = random.Random(seed)
+    cards = []
+    while len(cards) < card_count:
+        card = scryfall.get_random_card()
+        url = (scryfall.get_image_urls(card) or [None])[0]
+        image = fetch(url, cache_dir) if url else None
+        if image is not None:
+            cards.append((card.get("id"), image))
+    pairs = []
+    for card_id, image in cards:
+        pairs.append((image, simulate_photo(image, rng), True, "render/photo"))
+    for (id_a, image_a), (id_b, image_b) in zip(cards, cards[1:] + cards[:1]):
+        pairs.append((image_a, simulate_photo(image_b, rng), False, "render/photo"))
+    if crops_dir:
+        for filename in sorted(os.listdir(crops_dir)):
+            card = scryfall.get_card_by_id(filename[:36])
+            url = (scryfall.get_image_urls(card) or [None])[0] if card else None
+            render = fetch(url, cache_dir) if url else None
+            crop = cv.imread(os.path.join(crops_dir, filename), cv.IMREAD_COLOR)
+            if render is None or crop is None:
+                continue
+            pairs.append((render, crop, True, "render/reddit crop"))
+            pairs.append((rng.choice(cards)[1], crop, False, "render/reddit crop"))
+    return pairs
+
+
+def setting_box(image, box):
+    """Box of a setting, "frame" chooses it by the frame of the card whatever im_utils.frame_aware"""
+    return im_utils.frame_boxes[im_utils.classify_frame(image)] if box == "frame" else box
+
+
+def distances(pairs, bins, box):
+    result = []
+    for image_a, image_b, same, kind in pairs:
+        a = im_utils.descript_image(image_a, bins=bins, box=setting_box(image_a, box))
+        b = im_utils.descript_image(image_b, bins=bins, box=setting_box(image_b, box))
+        result.append((cv.compareHist(a, b, cv.HISTCMP_BHATTACHARYYA) * 100, same, kind))
+    return result
+
+
+def scores(scored_pairs, threshold):
+    tp = sum(1 for d, same, kind in scored_pairs if same and d < threshold)
+    fp = sum(1 for d, same, kind in scored_pairs if not same and d < threshold)
+    fn = sum(1 for d, same, kind in scored_pairs if same and d >= threshold)
+    precision = tp / (tp + fp) if tp + fp else 1.0
+    recall = tp / (tp + fn) if tp + fn else 1.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return precision, recall, f1
+
+
+def phash_distances(pairs):
+    """
+    :return: list of tuple (phash distance in bits, histogram distance x 100, is_same_card) with the bot descriptors
+    """
+    result = []
+    for image_a, image_b, same, kind in pairs:
+        (descr_a, phash_a), (descr_b, phash_b) = im_utils.describe_image(image_a), im_utils.describe_image(image_b)
+        hamming = int(im_utils.hamming_distances(phash_a, np.array([phash_b], dtype=np.int64))[0])
+        result.append((hamming, cv.compareHist(descr_a, descr_b, cv.HISTCMP_BHATTACHARYYA) * 100, same))
+    return result
+
+
+def two_stage_scores(scored_pairs, gate, threshold=29):
+    """
+    :return: tuple (same card pairs passing the gate, different card pairs passing the gate,
+    precision and recall of the gate then the histogram threshold)
+    """
+    same = [(h, d) for h, d, s in scored_pairs if s]
+    other = [(h, d) for h, d, s in scored_pairs if not s]
+    gate_recall = sum(1 for h, d in same if h <= gate) / len(same) if same else 1.0
+    gate_pass = sum(1 for h, d in other if h <= gate) / len(other) if other else 0.0
+    tp = sum(1 for h, d in same if h <= gate and d < threshold)
+    fp = sum(1 for h, d in other if h <= gate and d < threshold)
+    precision = tp / (tp + fp) if tp + fp else 1.0
+    recall = tp / len(same) if same else 1.0
+    return gate_recall, gate_pass, precision, recall
+
+
+def corpus_phashes(pairs):
+    """Phashes of the corpus images, queries are those of photos and crops"""
+    stored = [im_utils.phash(image_a) for image_a, image_b, same, kind in pairs if same]
+    queries = [im_utils.phash(image_b) for image_a, image_b, same, kind in pairs if same]
+    return np.array(stored, dtype=np.int64), np.array(queries, dtype=np.int64)
+
+
+def similar_hashes(hashes, count, rng, max_flips=4):
+    """Count hashes drawn from real card hashes with a few bits flipped, distinct but distributed like card art"""
+    drawn = hashes[rng.integers(len(hashes), size=count)]
+    for _ in range(max_flips):
+        flips = np.int64(1) << rng.integers(64, size=count).astype(np.int64)
+        drawn = np.where(rng.random(count) < 0.5, drawn ^ flips, drawn)
+    return drawn
+
+
+def random_descriptors(count, bins=(8, 8, 8), seed=0):
+    """Stored descriptors as the controller gives them: raw float32 bytes of normalized histograms"""
+    rng = np.random.default_rng(seed)
+    hists = rng.dirichlet(np.full(int(np.prod(bins)), 0.1), size=count).astype(np.float32)
+    hists /= np.linalg.norm(hists, axis=1, keepdims=True)
+    return [h.tobytes() for h in hists]
+
+
+def query_latency(size, hashes=None, queries=5):
+    """
+    Mean time of SpoilerDetector.is_duplicate against an index of random histograms
+    :param hashes: tuple (stored, query) phashes of real cards, histograms only if None
+    :return: tuple (seconds to build the index arrays, seconds per query, part of the index passing the phash gate)
+    """
+    rng = np.random.default_rng(size)
+    index = DescriptorIndex()
+    stored = similar_hashes(hashes[0], size, rng) if hashes is not None else [None] * size
+    for key, (descr, phash) in enumerate(zip(random_descriptors(size), stored)):
+        index.add(key, descr, int(phash) if phash is not None else None)
+    refs = [SimpleNamespace(descr=np.frombuffer(random_descriptors(1, seed=size + n)[0], dtype=np.float32),
+                            conf=None, phash=int(hashes[1][n % len(hashes[1])]) if hashes is not None else None)
+            for n in range(queries)]
+    # Arrays are built by the first query after a change, once per crawl in the bot, not at each query
+    start = perf_counter()
+    index.arrays()
+    build = perf_counter() - start
+    # Time the gate even while it is off in the bot
+    phash_gate = SpoilerDetector.phash_gate
+    SpoilerDetector.phash_gate = hashes is not None
+    try:
+        start = perf_counter()
+        for ref in refs:
+            SpoilerDetector.is_duplicate(ref, index)
+        elapsed = (perf_counter() - start) / queries
+    finally:
+        SpoilerDetector.phash_gate = phash_gate
+    if hashes is None:
+        return build, elapsed, 1.0
+    passing = np.mean([np.mean(im_utils.hamming_distances(ref.phash, np.array(stored, dtype=np.int64))
+                               <= SpoilerDetector.phash_distance) for ref in refs])
+    return build, elapsed, float(passing)
+
+
+def report(pairs):
+    lines = ["# Duplicate detection benchmark", "",
+             f"{sum(1 for p in pairs if p[2])} same card pairs, {sum(1 for p in pairs if not p[2])} different card pairs",
+             ""]
+    for name, setting in descriptor_settings.items():
+        scored = distances(pairs, **setting)
+        lines += [f"## {name}", "", "| threshold | precision | recall | f1 |", "|---|---|---|---|"]
+        for threshold in sorted(set(thresholds)):
+            precision, recall, f1 = scores(scored, threshold)
+            lines.append(f"| {threshold} | {precision:.3f} | {recall:.3f} | {f1:.3f} |")
+        for kind, group in itertools.groupby(sorted(scored, key=lambda x: x[2]), key=lambda x: x[2]):
+            group = list(group)
+            same = [d for d, s, k in group if s]
+            other = [d for d, s, k in group if not s]
+            lines.append(f"\n{kind}: same card distance median {np.median(same):.1f} (p95 {np.percentile(same, 95):.1f}), "
+                         f"different card median {np.median(other):.1f} (p5 {np.percentile(other, 5):.1f})")
+        lines.append("")
+    scored = phash_distances(pairs)
+    lines += ["## Two stages: phash gate then histograms", "",
+              f"Bot descriptors, histogram threshold 29 like is_duplicate, "
+              f"current gate {SpoilerDetector.phash_distance} bits "
+              f"({'on' if SpoilerDetector.phash_gate else 'off'} in the bot)", "",
+              "| max phash distance | same card pairs passing | different card pairs passing | precision | recall |",
+              "|---|---|---|---|---|"]
+    for gate in phash_gates:
+        gate_recall, gate_pass, precision, recall = two_stage_scores(scored, gate)
+        lines.append(f"| {gate} | {gate_recall:.3f} | {gate_pass:.3f} | {precision:.3f} | {recall:.3f} |")
+    lines.append("")
+    hashes = corpus_phashes(pairs)
+    lines += ["## Query latency of is_duplicate", "",
+              "Stored phashes are drawn from the corpus cards, queries are phashes of their photos and crops.", "",
+              "| stored descriptors | index build, ms | histograms only, ms per query "
+              "| phash + histograms, ms per query | part of the index passing the gate |",
+              "|---|---|---|---|---|"]
+    for size in index_sizes:
+        build, histograms_only, _ = query_latency(size)
+        _, two_stages, passing = query_latency(size, hashes)
+        lines.append(f"| {size} | {build * 1000:.1f} | {histograms_only * 1000:.1f} | {two_stages * 1000:.1f} "
+                     f"| {passing:.3f} |")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark duplicate detection accuracy and speed")
+    parser.add_argument("--cards", type=int, default=100, help="number of random scryfall cards in the corpus")
+    parser.add_argument("--crops", help="directory of labelled reddit crops named <scryfall_id>*.jpg")
+    parser.add_argument("--cache", default=os.path.join("benchmarks", "cache"), help="image cache directory")
+    parser.add_argument("--report", help="write the markdown report to this file")
+    args = parser.parse_args()
+    os.makedirs(args.cache, exist_ok=True)
+    text = report(build_corpus(args.cards, args.cache, args.crops))
+    print(text)
+    if args.report:
+        with open(args.report, "w") as f:
+            f.write(text)
@@ -0,0 +1,139 @@
+"""
+MythicSpoiler parsing benchmark: streaming parsers of mythicspoiler.py against the previous BeautifulSoup
+implementation, on saved pages (fixtures of benchmarks.pipeline) or on a generated news page.
+
+    python -m benchmarks.parsing --fixtures fixtures/
+    python -m benchmarks.parsing --synthetic 2000
+
+Reports mean time per page and checks both implementations extract the same cards.
+"""
+import os
+import re
+import argparse
+from time import perf_counter
+from mythicspoiler import MythicSpoiler
+
+
+def legacy_cards_from_news(text, url=MythicSpoiler.url):
+    """get_cards_from_news before the streaming parser, without the fetch"""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(text, 'html.parser')
+    tags = soup.find_all('a', {'href': re.compile(MythicSpoiler.page_reg.pattern)})
+    cards = []
+    expansion = None
+    for tag in tags:
+        page = url + tag.get("href", "").replace("\n", "")
+        image_url = None
+        if ".html" not in os.path.splitext(tag.get("href"))[1]:
+            page = None
+        if tag.img:
+            image_url = url + tag.img.get("src", "").replace("\n", "")
+        if page:
+            reg = re.compile(r"https://mythicspoiler\.com\/(.*)\/cards/")
+            match = reg.findall(page)
+            if len(match):
+                expansion = match[0]
+            else:
+                expansion = None
+        if image_url:
+            cards.append((page, image_url, expansion))
+    return cards
+
+
+def legacy_card_info(text):
+    """get_card_info before the streaming parser, without the fetch"""
+    from bs4 import BeautifulSoup, Comment, Tag, NavigableString
+    card_types = MythicSpoiler.card_types
+    infos = {}
+    result = re.compile(r"<!--CARD TEXT-->(\n|.)*<!--END CARD TEXT-->").search(text)
+    if not result:
+        return None
+    soup = BeautifulSoup(result.group(0), 'html.parser')
+    for e in soup.findAll('br'):
+        e.extract()
+    for c in soup.contents:
+        if isinstance(c, Tag):
+            for comment in c.findAll(text=lambda t: isinstance(t, Comment)):
+                if comment in card_types.keys():
+                    info = ""
+                    v = comment.next_element
+                    while isinstance(v, NavigableString) and "END CARD" not in v.string \
+                            and v.string not in card_types.keys():
+                        info += re.sub(pattern=r'(^(?:\\n)+|(?:\\n)+$)', repl='', string=v.string)
+                        v = v.next_element
+                    info = re.sub(pattern=r'(^(?:\n)+|(?:\n)+$)', repl='', string=info.strip())
+                    info = re.sub(pattern=r'(\n)+', repl='\n', string=info)
+                    infos[card_types[comment]] = info
+    return infos
+
+
+def synthetic_news(count):
+    """News page shaped like mythicspoiler.com/newspoilers.html with count cards"""
+    cards = []
+    for n in range(count):
+        expansion = ("khm", "stx", "tsr")[n % 3]
+        cards.append(f'<!--CARD--><div class="grid-card">\n<a href="{expansion}/cards/card{n}.html">'
+                     f'<img class="" src="{expansion}/cards/card{n}.jpg" width="100%"></a>\n'
+                     f'<font class="cardname">Card {n}</font></div>')
+    return "<html><head><title>New spoilers</title></head><body><table><tr><td>" \
+           + "\n".join(cards) + "</td></tr></table></body></html>"
+
+
+def timeit(func, *args, repeat=5):
+    start = perf_counter()
+    for _ in range(repeat):
+        result = func(*args)
+    return (perf_counter() - start) / repeat, result
+
+
+def load_pages(fixtures):
+    """Saved mythicspoiler pages of the fixtures: (news pages, card pages)"""
+    news, cards = [], []
+    root = os.path.join(fixtures, "mythicspoiler.com")
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            with open(path, encoding="utf-8", errors="replace") as f:
+                text = f.read()
+            if "<!--CARD TEXT-->" in text:
+                cards.append(text)
+            elif filename.startswith("newspoilers"):
+                news.append(text)
+    return news, cards
+
+
+def report(news, cards):
+    ms = MythicSpoiler()
+    lines = [f"{'page':<28}{'legacy ms':>12}{'streaming ms':>14}{'speedup':>10}  same result"]
+    for n, text in enumerate(news):
+        legacy, expected = timeit(legacy_cards_from_news, text)
+        streaming, result = timeit(ms.parse_news, text)
+        lines.append(f"{f'news {n} ({len(result)} cards)':<28}{legacy * 1000:>12.1f}{streaming * 1000:>14.1f}"
+                     f"{legacy / streaming:>9.1f}x  {result == expected}")
+        known = {image_url for page, image_url, expansion in result}
+        seen, result = timeit(ms.parse_news, text, known)
+        lines.append(f"{f'news {n}, all cards seen':<28}{legacy * 1000:>12.1f}{seen * 1000:>14.1f}"
+                     f"{legacy / seen:>9.1f}x  stopped after {len(result)} cards")
+    if cards:
+        legacy = streaming = 0
+        same = 0
+        for text in cards:
+            duration, expected = timeit(legacy_card_info, text)
+            legacy += duration
+            duration, result = timeit(ms.parse_card_info, text)
+            streaming += duration
+            same += result == expected
+        lines.append(f"{f'{len(cards)} card pages':<28}{legacy / len(cards) * 1000:>12.1f}"
+                     f"{streaming / len(cards) * 1000:>14.1f}{legacy / streaming:>9.1f}x  {same}/{len(cards)}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark MythicSpoiler page parsing")
+    parser.add_argument("--fixtures", help="fixtures directory recorded by benchmarks.pipeline")
+    parser.add_argument("--synthetic", type=int, default=0, help="also parse a generated news page of N cards")
+    args = parser.parse_args()
+    news, cards = load_pages(args.fixtures) if args.fixtures else ([], [])
+    if args.synthetic:
+        news.append(synthetic_news(args.synthetic))
+    print(report(news, cards))
@@ -0,0 +1,263 @@
+"""
+Replay recorded fixtures through SpoilerController crawl methods without network nor telegram,
+then report latency per stage, throughput and peak memory.
+
+Fixtures are a mirror of the fetched urls, one directory per host:
+    fixtures/api.scryfall.com/cards/search.json
+    fixtures/mythicspoiler.com/newspoilers.html
+    fixtures/c1.scryfall.com/file/.../card.jpg
+    fixtures/reddit/submissions.pkl  (list of submission attribute dicts)
+Urls with a query are saved as <path>@<hash of query>, the file without query is used when the query differs
+(scryfall searches contain the current date).
+
+Record fixtures once with live sources (needs reddit credentials in config.py):
+    python -m benchmarks.pipeline fixtures/ --record
+Replay them:
+    python -m benchmarks.pipeline fixtures/ --cycles 2
+"""
+import os
+import json
+import pickle
+import hashlib
+import resource
+import tempfile
+import argparse
+import threading
+from time import perf_counter
+from collections import defaultdict
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from functools import partial
+import requests
+import config
+
+# Attributes of praw submissions used by the crawl
+submission_attributes = ["id", "title", "permalink", "domain", "spoiler", "link_flair_text",
+                         "is_gallery", "media_metadata", "preview"]
+suffixes = ["", ".json", ".html"]
+
+
+def fixture_path(root, url, with_query=True):
+    parts = urlsplit(url)
+    path = parts.path.strip("/") or "index.html"
+    if with_query and parts.query:
+        path += "@" + hashlib.sha1(parts.query.encode()).hexdigest()[:12]
+    return os.path.join(root, parts.netloc, path)
+
+
+class FixtureHandler(SimpleHTTPRequestHandler):
+    """Serve fixture files, /<host>/<path>?<query>"""
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        host, _, path = parts.path.lstrip("/").partition("/")
+        url = f"https://{host}/{path}" + (f"?{parts.query}" if parts.query else "")
+        for with_query in (True, False):
+            for suffix in suffixes:
+                filename = fixture_path(self.directory, url, with_query) + suffix
+                if os.path.isfile(filename):
+                    with open(filename, "rb") as f:
+                        content = f.read()
+                    self.send_response(200)
+                    self.send_header("Content-Length", str(len(content)))
+                    self.end_headers()
+                    self.wfile.write(content)
+                    return
+        self.send_error(404)
+
+    def log_message(self, *args):
+        pass
+
+
+class FixtureServer:
+    """Local HTTP stand-in for scryfall, mythicspoiler and image hosts"""
+
+    def __init__(self, root, record=False):
+        self.root = root
+        self.record = record
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), partial(FixtureHandler, directory=root))
+        self.thread = threading.Thread(target=self.server.serve_forever, name="FixtureServer", daemon=True)
+        self.real_get = requests.get
+
+    def start(self):
+        self.thread.start()
+        requests.get = self.get
+
+    def stop(self):
+        requests.get = self.real_get
+        self.server.shutdown()
+
+    def local_url(self, url):
+        parts = urlsplit(url)
+        return f"http://127.0.0.1:{self.server.server_port}/{parts.netloc}{parts.path}" \
+               + (f"?{parts.query}" if parts.query else "")
+
+    def get(self, url, *args, **kwargs):
+        if self.record:
+            self.save(url)
+        return self.real_get(self.local_url(url), *args, **kwargs)
+
+    def save(self, url):
+        filename = fixture_path(self.root, url)
+        if os.path.isfile(filename):
+            return
+        r = self.real_get(url)
+        if not r.ok:
+            return
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        for name in {filename, fixture_path(self.root, url, with_query=False)}:
+            if not os.path.isfile(name):
+                with open(name, "wb") as f:
+                    f.write(r.content)
+
+
+class FixtureSubreddit:
+    """Stand-in for praw subreddit returning recorded submissions"""
+
+    def __init__(self, submissions):
+        self.submissions = submissions
+
+    def new(self):
+        return list(self.submissions)
+
+
+def load_submissions(root):
+    with open(os.path.join(root, "reddit", "submissions.pkl"), "rb") as f:
+        return [SimpleNamespace(**attributes) for attributes in pickle.load(f)]
+
+
+def save_submissions(root, submissions):
+    os.makedirs(os.path.join(root, "reddit"), exist_ok=True)
+    data = [{a: getattr(s, a) for a in submission_attributes if hasattr(s, a)} for s in submissions]
+    with open(os.path.join(root, "reddit", "submissions.pkl"), "wb") as f:
+        pickle.dump(data, f)
+
+
+class Stages:
+    """Time functions by stage, nested calls are subtracted from their parent stage (self time)"""
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            stack = self.local.__dict__.setdefault("stack", [])
+            stack.append(0.0)
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                total = perf_counter() - start
+                children = stack.pop()
+                if stack:
+                    stack[-1] += total
+                with self.lock:
+                    self.durations[stage].append(total - children)
+        return timed
+
+    def patch(self, owner, name, stage, static=False):
+        func = getattr(owner, name)
+        wrapped = self.wrap(stage, func)
+        setattr(owner, name, staticmethod(wrapped) if static else wrapped)
+
+    def report(self):
+        lines = [f"{'stage':<12}{'calls':>8}{'total s':>10}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}"]
+        for stage, durations in sorted(self.durations.items()):
+            d = sorted(durations)
+            lines.append(f"{stage:<12}{len(d):>8}{sum(d):>10.3f}{sum(d) / len(d) * 1000:>10.1f}"
+                         f"{d[len(d) // 2] * 1000:>10.1f}{d[int(len(d) * 0.95)] * 1000:>10.1f}{d[-1] * 1000:>10.1f}")
+        return "\n".join(lines)
+
+
+class UnlimitedBucket:
+    """Stand-in for publisher token buckets, the benchmark measures the pipeline and not telegram limits"""
+
+    def consume(self, tokens=1):
+        pass
+
+
+class BenchBot:
+    """Stand-in for telegram bot, sends are only counted"""
+
+    def __init__(self):
+        self.sent = 0
+
+    def send_photo(self, chat_id, photo, caption, **kwargs):
+        self.sent += 1
+        return SimpleNamespace(photo=[SimpleNamespace(file_id=f"file-{self.sent}")])
+
+    def send_media_group(self, chat_id, media, **kwargs):
+        self.sent += len(media)
+        return [SimpleNamespace(photo=[SimpleNamespace(file_id=f"file-{self.sent}-{n}")]) for n in range(len(media))]
+
+    def send_message(self, chat_id, text, **kwargs):
+        pass
+
+
+def run(root, cycles=1, record=False):
+    # Work on a throwaway database, must be set before model is imported
+    db_dir = tempfile.mkdtemp()
+    config.db = f"sqlite:///{os.path.join(db_dir, 'bench.db')}"
+    config.cluster = False
+    import im_utils
+    from sqlalchemy.orm import Session as SqlSession
+    from yolo import Yolo
+    from spoiler_detector import SpoilerDetector
+    from cluster import HarnessUpdater, HarnessContext
+    from spoiler_controller import SpoilerController
+
+    stages = Stages()
+    server = FixtureServer(root, record=record)
+    server.get = stages.wrap("fetch", server.get)
+    server.start()
+    stages.patch(im_utils, "descript_image", "descriptor")
+    stages.patch(Yolo, "get_detected_objects", "yolo")
+    stages.patch(SpoilerDetector, "find_duplicate", "dedup", static=True)
+    stages.patch(SpoilerDetector, "remove_duplicates", "dedup", static=True)
+    stages.patch(SqlSession, "flush", "db")
+    stages.patch(SqlSession, "commit", "db")
+    bot = BenchBot()
+    for name in ("send_photo", "send_media_group"):
+        stages.patch(bot, name, "send")
+
+    controller = SpoilerController(updater=HarnessUpdater(bot))
+    controller.publisher.bucket = UnlimitedBucket()
+    controller.publisher.get_chat_bucket = lambda chat_id: UnlimitedBucket()
+    context = HarnessContext(bot)
+    if record:
+        save_submissions(root, controller.reddit.subreddit.new())
+    controller.reddit.subreddit = FixtureSubreddit(load_submissions(root))
+
+    crawls = [controller.update_db, controller.scryfall_cards_crawl, controller.mythicspoiler_crawl,
+              controller.reddit_crawl]
+    start = perf_counter()
+    for n in range(cycles):
+        for crawl in crawls:
+            stages.wrap("crawl", crawl)(context)
+        controller.publisher.queue.join()
+    elapsed = perf_counter() - start
+    server.stop()
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on linux
+    spoilers = len(controller.spoiled)
+    print(stages.report())
+    print(f"\n{cycles} cycle(s) in {elapsed:.2f}s, {spoilers} spoilers ({spoilers / elapsed:.2f}/s), "
+          f"{bot.sent} photos sent, peak RSS {peak_rss:.0f} MB")
+    return {"elapsed": elapsed, "spoilers": spoilers, "sent": bot.sent, "peak_rss_mb": peak_rss,
+            "stages": {k: {"calls": len(v), "total": sum(v)} for k, v in stages.durations.items()}}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded fixtures through the detection pipeline")
+    parser.add_argument("fixtures", help="fixtures directory")
+    parser.add_argument("--cycles", type=int, default=1, help="crawl cycles, the next ones only see known items")
+    parser.add_argument("--record", action="store_true", help="fetch missing fixtures from live sources")
+    parser.add_argument("--json", help="also write results to this file")
+    args = parser.parse_args()
+    results = run(os.path.abspath(args.fixtures), cycles=args.cycles, record=args.record)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
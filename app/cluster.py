@@ -0,0 +1,157 @@
+import zlib
+import config
+from datetime import datetime, timedelta
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from model import session_factory, Node, Lease, worker_id
+
+
+class Cluster:
+    """
+    Share the crawl between several bot processes using the same database.
+    Every node sends heartbeats, items of each source are sharded between alive nodes
+    and the node holding the leader lease is the only one publishing to telegram.
+    """
+
+    leader_lease = "leader"
+    ttl = timedelta(seconds=90)  # Node considered dead and lease free after this delay without heartbeat
+    # The leader stops publishing this long before its lease expires, covers clock drift between nodes
+    lease_margin = timedelta(seconds=10)
+
+    def __init__(self, enabled=True, node_id=worker_id):
+        self.enabled = enabled
+        self.node_id = node_id
+        self.nodes = [node_id]
+        # Without cluster, this node does everything
+        self.leader = not enabled
+        # End of the leader lease held by this node, the lease may be taken by another node after it
+        self.lease_expires_at = None
+
+    def heartbeat(self, context=None):
+        """Refresh this node, try to get or keep the leader lease and update the list of alive nodes"""
+        if not self.enabled:
+            return
+        local_session = session_factory()
+        now = datetime.now()
+        try:
+            local_session.merge(Node(id=self.node_id, heartbeat_at=now))
+            local_session.commit()
+            leader = self.acquire_lease(local_session, now)
+            self.lease_expires_at = now + self.ttl if leader else None
+            if leader != self.leader:
+                config.bot_logger.info(f"Node {self.node_id} {'is now' if leader else 'is no longer'} the leader.")
+            self.leader = leader
+            alive = local_session.query(Node.id).filter(Node.heartbeat_at > now - self.ttl)
+            self.nodes = sorted({n.id for n in alive} | {self.node_id})
+        finally:
+            local_session.close()
+
+    def is_leader(self):
+        """
+        True if this node holds a lease which is not about to expire. A crawl longer than the lease delays the
+        heartbeat renewing it, another node may take the lease meanwhile: this node stops publishing before.
+        """
+        if not self.enabled:
+            return True
+        return self.leader and datetime.now() < self.lease_expires_at - self.lease_margin
+
+    def acquire_lease(self, local_session, now):
+        """
+        Take the leader lease if it is free or expired, renew it if this node already holds it
+        :return: True if this node is the leader
+        """
+        renewed = local_session.query(Lease)\
+            .filter(Lease.name == self.leader_lease,
+                    or_(Lease.holder == self.node_id, Lease.expires_at < now))\
+            .update({Lease.holder: self.node_id, Lease.expires_at: now + self.ttl}, synchronize_session=False)
+        local_session.commit()
+        if renewed:
+            return True
+        if local_session.query(Lease).get(self.leader_lease) is None:
+            # First election
+            local_session.add(Lease(name=self.leader_lease, holder=self.node_id, expires_at=now + self.ttl))
+            try:
+                local_session.commit()
+                return True
+            except IntegrityError:
+                # Another node won the election
+                local_session.rollback()
+        return False
+
+    def owns(self, key: str):
+        """Return True if the item key is in the shard of this node"""
+        if not self.enabled or len(self.nodes) == 1:
+            return True
+        return self.nodes[zlib.crc32(key.encode()) % len(self.nodes)] == self.node_id
+
+
+class HarnessBot:
+    """Stand-in for telegram bot printing sends with the node id"""
+
+    def __init__(self, node_id):
+        self.node_id = node_id
+
+    def send_photo(self, chat_id, photo, caption, **kwargs):
+        print(f"[{self.node_id}] send_photo to {chat_id}: {caption!r}", flush=True)
+
+    def send_media_group(self, chat_id, media, **kwargs):
+        print(f"[{self.node_id}] send_media_group to {chat_id}: {[m.caption for m in media]!r}", flush=True)
+
+    def send_message(self, chat_id, text, **kwargs):
+        print(f"[{self.node_id}] send_message to {chat_id}: {text!r}", flush=True)
+
+
+class HarnessJobQueue:
+    """Jobs are run by the harness loop instead"""
+
+    def run_repeating(self, callback, interval, first=None, **kwargs):
+        pass
+
+
+class HarnessUpdater:
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.job_queue = HarnessJobQueue()
+
+
+class HarnessContext:
+
+    def __init__(self, bot):
+        self.bot = bot
+
+
+def run_node(cycles, interval):
+    """Run one node of the local harness: heartbeat, crawl then publish (the scheduler tasks), cycles times"""
+    from time import sleep
+    config.cluster = True
+    from spoiler_controller import SpoilerController
+    from model import worker_id
+    bot = HarnessBot(worker_id)
+    controller = SpoilerController(updater=HarnessUpdater(bot))
+    context = HarnessContext(bot)
+    for n in range(cycles):
+        controller.scheduler.run_all(context)
+        print(f"[{controller.cluster.node_id}] cycle {n + 1}/{cycles} done, leader={controller.cluster.is_leader()}, "
+              f"nodes={len(controller.cluster.nodes)}", flush=True)
+        sleep(interval)
+    # Let the publisher send what is left
+    controller.publisher.queue.join()
+
+
+if __name__ == "__main__":
+    # Local multi-process harness: several nodes crawl against the database of config.db,
+    # check in the output that each spoiler is sent once and only by the leader.
+    import argparse
+    import multiprocessing
+    parser = argparse.ArgumentParser(description="Run several crawler nodes on this machine")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--cycles", type=int, default=3)
+    parser.add_argument("--interval", type=int, default=30, help="seconds between cycles")
+    args = parser.parse_args()
+    ctx = multiprocessing.get_context("spawn")
+    processes = [ctx.Process(target=run_node, args=(args.cycles, args.interval)) for n in range(args.nodes)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
@@ -1,14 +1,14 @@
 import os
+import threading
 import uuid
+import hashlib
 import cv2 as cv
 import numpy as np
-import scryfall
+import metrics
 import requests
 import random
-import tqdm
 import re
 from io import BytesIO
-from PIL import Image
 # from imagehash import phash
 # import distance
 # from config import hash_size
@@ -28,23 +28,36 @@ def is_url(s: str):
     return re.match(regex, s) is not None
 
 
-def get_file_from_cv_image(image: np.ndarray):
+def get_file_from_cv_image(image: np.ndarray, quality=90):
     """
     transform image to binary file like object
-    :param image: open_cv image array
-    :return: None
+    :param image: open_cv image array (BGR)
+    :param quality: jpeg quality from 0 to 100
+    :return: jpeg file like object
     """
-    # return cv.imencode('.jpg', image)[1].tostring()
-    img = cv.cvtColor(image, cv.COLOR_BGR2RGB)
-    im_pil = Image.fromarray(img)
-    bio = BytesIO()
+    ok, buffer = cv.imencode('.jpg', image, [cv.IMWRITE_JPEG_QUALITY, quality])
+    bio = BytesIO(buffer.tobytes())
     bio.name = 'image.jpeg'
-    im_pil.save(bio, 'JPEG')
-    bio.seek(0)
     return bio
 
 
-def get_illustration(card_image, box=(0.5, 0.332265, 0.855655, 0.448718)):
+# Version of the descriptors computed by describe_image, stored with them.
+# Bump it when descript_image, phash or the illustration boxes change, then run reprocess.py
+# NULL: regular box, 2: box by frame, 3: regular box again while frame aware boxes are not benchmarked
+descriptor_version = 3
+
+# Relative box (center_x, center_y, width, height) of the illustration on a regular card
+illustration_box = (0.5, 0.332265, 0.855655, 0.448718)
+
+
+def crop_relative(image, box):
+    """Crop image to box (x1, y1, x2, y2) relative to its size"""
+    height, width = image.shape[:2]
+    x1, y1, x2, y2 = box
+    return image[int(y1 * height):int(y2 * height), int(x1 * width):int(x2 * width)]
+
+
+def get_illustration(card_image, box=illustration_box):
     """Take cv card image and return portion of image containing card illustration
     Typical card box (yolo):
         center_x = 0.502232
@@ -61,6 +74,72 @@ def get_illustration(card_image, box=(0.5, 0.332265, 0.855655, 0.448718)):
     return card_image[y1:y2, x1:x2]
 
 
+# Illustration box by card frame, art printed up to the border (extended art) or to the edges (borderless)
+# covers the width of the card
+frame_boxes = {"regular": illustration_box,
+               "extended": (0.5, 0.335, 0.91, 0.45),
+               "borderless": (0.5, 0.335, 0.96, 0.45)}
+card_ratio = 63 / 88
+# Choose the box by frame instead of the regular box for every card. Off until benchmarks.dedup shows
+# the "8x8x8 frame aware" setting matches better than "8x8x8 illustration", bump descriptor_version to change it
+frame_aware = False
+# Box chosen for the last described urls
+roi_cache = {}
+roi_cache_size = 4096
+
+
+def is_uniform(lines, tolerance):
+    """
+    True if each line is uniform: most of its pixels close to its median, a few pixels of glare don't count
+    :param lines: 2d array, one line per row
+    """
+    deviation = np.abs(lines - np.median(lines, axis=1, keepdims=True))
+    return bool(np.all(np.mean(deviation <= tolerance, axis=1) >= 0.9))
+
+
+def classify_frame(card_image, tolerance=20):
+    """
+    Guess the frame of a card from a thumbnail: uniform outer border or not (borderless),
+    then uniform strip just inside the border (regular frame) or not (extended art).
+    Strips are tested column by column along the card, so a border a pixel wider or narrower than expected
+    (yolo crops of photos) still gives uniform columns.
+    :return: key of frame_boxes
+    """
+    height, width = card_image.shape[:2]
+    if not height or abs(width / height - card_ratio) > 0.08:
+        # Not a whole card (crop cut by the photo edge, screenshot), keep the usual box
+        return "regular"
+    if card_image.ndim == 3:
+        card_image = cv.cvtColor(card_image, cv.COLOR_BGRA2GRAY if card_image.shape[2] == 4 else cv.COLOR_BGR2GRAY)
+    small = cv.resize(card_image, (128, 180), interpolation=cv.INTER_AREA).astype(np.float32)
+    # Left, right and bottom border without the rounded corners, the top border is often lighter.
+    # The outermost pixels are left out, yolo crops of photos often hold a line of background there
+    sides = (small[20:-20, 2:5].T, small[20:-20, -5:-2].T, small[-5:-2, 16:-16])
+    if not all(is_uniform(side, tolerance) for side in sides):
+        return "borderless"
+    # Frame on both sides of the illustration
+    inner = np.vstack((small[24:90, 6:9].T, small[24:90, -9:-6].T))
+    return "regular" if is_uniform(inner, tolerance) else "extended"
+
+
+def get_roi(cv_im, url=None):
+    """
+    Illustration box of a card image, the regular box unless frame_aware
+    :param cv_im: the card image
+    :param url: where the image was read from, the box is cached by url
+    """
+    if not frame_aware:
+        return illustration_box
+    if url is None:
+        return frame_boxes[classify_frame(cv_im)]
+    box = roi_cache.get(url)
+    if box is None:
+        box = roi_cache[url] = frame_boxes[classify_frame(cv_im)]
+        if len(roi_cache) > roi_cache_size:
+            roi_cache.pop(next(iter(roi_cache)))
+    return box
+
+
 # def hash_cv_image(image):
 #     return str(phash(Image.fromarray(image), hash_size=hash_size))
 
@@ -76,29 +155,91 @@ def get_illustration(card_image, box=(0.5, 0.332265, 0.855655, 0.448718)):
 #     return hash
 
 
-def descript_image(image):
+def read_image(image):
+    """Return open_cv image array from an array, an url or a path"""
     if isinstance(image, np.ndarray):
-        cv_im = image
+        return image
     elif is_url(image):
-        cv_im = imread_url(image)
+        return imread_url(image)
     else:
-        cv_im = cv.imread(image, cv.IMREAD_UNCHANGED)
+        return cv.imread(image, cv.IMREAD_UNCHANGED)
+
 
-    cv_im = get_illustration(cv_im)
-    hist = cv.calcHist([cv_im], [0, 1, 2], None, [8, 8, 8], [0, 256, 0, 256, 0, 256])
+@metrics.timed("descript_image")
+def descript_image(image, bins=(8, 8, 8), box=None):
+    """
+    Compute color histogram of the card illustration
+    :param image: open_cv image array, url or path of a card image
+    :param bins: number of bins per channel
+    :param box: relative box of the illustration, (0.5, 0.5, 1, 1) for the whole image, chosen by frame if None
+    :return: normalized flat histogram (float32)
+    """
+    cv_im = read_image(image)
+    cv_im = get_illustration(cv_im, box or get_roi(cv_im, image if isinstance(image, str) else None))
+    hist = cv.calcHist([cv_im], [0, 1, 2], None, list(bins), [0, 256, 0, 256, 0, 256])
     hist = cv.normalize(hist, hist).flatten()
     return hist
 
 
-# def get_closest_hashes(phash, phashes, limit=20):
-#     return sorted([(distance.hamming(phash, h), h) for h in phashes], key=lambda x: x[0])[:limit]
+def phash(image, box=None):
+    """
+    64 bits perceptual hash of the card illustration (same algorithm as imagehash.phash):
+    low frequencies of the DCT of the grayscale illustration compared to their median
+    :param box: relative box of the illustration, chosen by frame if None
+    :return: hash as signed 64 bits int, to fit in a db integer
+    """
+    cv_im = read_image(image)
+    cv_im = get_illustration(cv_im, box or get_roi(cv_im, image if isinstance(image, str) else None))
+    if cv_im.ndim == 3:
+        cv_im = cv.cvtColor(cv_im, cv.COLOR_BGRA2GRAY if cv_im.shape[2] == 4 else cv.COLOR_BGR2GRAY)
+    small = cv.resize(cv_im, (32, 32), interpolation=cv.INTER_AREA).astype(np.float32)
+    low_freq = cv.dct(small)[:8, :8]
+    bits = np.packbits((low_freq > np.median(low_freq)).flatten())
+    return int(bits.view(">i8")[0])
 
 
-def get_closest_match(ref, objects, limit=10):
-    distances = sorted([(cv.compareHist(ref.descr, np.frombuffer(o, dtype=ref.descr.dtype), cv.HISTCMP_BHATTACHARYYA) * 100, np.frombuffer(o, dtype=ref.descr.dtype)) for o in objects], key=lambda x: x[0])[:limit]
-    if len(distances):
-        ref.conf = int(distances[0][0])
-    return distances
+def content_hash(image):
+    """Hash of the pixels of an open_cv image, same image downloaded from another url gives the same hash"""
+    return hashlib.sha1(np.ascontiguousarray(image).data).hexdigest()
+
+
+def describe_image(image, url=None):
+    """
+    Read image once and compute both descriptors
+    :param url: where an image array was downloaded from, to reuse the box chosen for it
+    :return: tuple (histogram, phash)
+    """
+    cv_im = read_image(image)
+    box = get_roi(cv_im, url or (image if isinstance(image, str) else None))
+    return descript_image(cv_im, box=box), phash(cv_im, box)
+
+
+def hamming_distances(ref, hashes):
+    """Number of different bits between a 64 bits hash and an int64 array of hashes"""
+    xor = np.bitwise_xor(hashes, np.int64(ref))
+    return np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+def sqrt_histograms(hists):
+    """Square root of histograms scaled to unit sum, their dot product gives the Bhattacharyya coefficient"""
+    hists = np.atleast_2d(np.asarray(hists, dtype=np.float32))
+    sums = hists.sum(axis=1, keepdims=True)
+    sums[sums == 0] = 1
+    return np.sqrt(hists / sums)
+
+
+def bhattacharyya_distances(ref, sqrt_hists):
+    """
+    Bhattacharyya distances (as cv.compareHist HISTCMP_BHATTACHARYYA) between one histogram and many
+    :param ref: histogram
+    :param sqrt_hists: matrix of sqrt_histograms
+    """
+    coefficients = sqrt_hists @ sqrt_histograms(ref)[0]
+    return np.sqrt(np.clip(1 - coefficients, 0, None))
+
+
+# def get_closest_hashes(phash, phashes, limit=20):
+#     return sorted([(distance.hamming(phash, h), h) for h in phashes], key=lambda x: x[0])[:limit]
 
 
 def show(img, title='image opencv'):
@@ -195,16 +336,13 @@ def overlay_image_alpha(img, img_overlay, pos, alpha_mask):
     if y1 >= y2 or x1 >= x2 or y1o >= y2o or x1o >= x2o:
         return
 
-    channels = img.shape[2]
-
-    alpha = alpha_mask[y1o:y2o, x1o:x2o]
-    alpha_inv = 1.0 - alpha
-
-    for c in range(channels):
-        img[y1:y2, x1:x2, c] = (alpha * img_overlay[y1o:y2o, x1o:x2o, c] +
-                                alpha_inv * img[y1:y2, x1:x2, c])
+    # Blend all channels at once, alpha broadcast over the channel axis
+    alpha = alpha_mask[y1o:y2o, x1o:x2o, np.newaxis]
+    region = img[y1:y2, x1:x2]
+    region[:] = alpha * img_overlay[y1o:y2o, x1o:x2o] + (1.0 - alpha) * region
 
 
+@metrics.timed("imread_url")
 def imread_url(url, flags=cv.IMREAD_UNCHANGED):
     """Return cv image from URL, None if url invalid"""
     if not url:
@@ -214,10 +352,36 @@ def imread_url(url, flags=cv.IMREAD_UNCHANGED):
     if resp.ok:
         image = np.asarray(bytearray(resp.raw.read()), dtype="uint8")
         image = cv.imdecode(image, flags)
+    else:
+        metrics.count_http_failure(url)
     return image
 
 
+def download_cached(url, cache_dir):
+    """Download url once in cache_dir, return the file path or None if url invalid"""
+    filename = os.path.join(cache_dir, hashlib.sha1(url.encode()).hexdigest())
+    if os.path.isfile(filename):
+        return filename
+    resp = requests.get(url)
+    if not resp.ok:
+        metrics.count_http_failure(url)
+        return None
+    # Write then rename, other processes and threads never read a partial file
+    partial = f"{filename}.{os.getpid()}.{threading.get_ident()}"
+    with open(partial, "wb") as f:
+        f.write(resp.content)
+    os.replace(partial, filename)
+    return filename
+
+
+def imread_cached(url, cache_dir, flags=cv.IMREAD_UNCHANGED):
+    """Return cv image from URL, downloaded once in cache_dir. None if url invalid"""
+    filename = download_cached(url, cache_dir)
+    return cv.imread(filename, flags) if filename else None
+
+
 def generate_yolo_image(folder, cards):
+    import scryfall
     #cards = [scryfall.get_random_card() for i in range(im_num+1)]
     background = imread_url(scryfall.get_image_urls(cards.pop(), size="art_crop")[0])
     if background is not None:
@@ -233,14 +397,18 @@ def generate_yolo_image(folder, cards):
         write_yolo_label_image(os.path.join(folder, f"{uid}.txt"), 0, positions)
 
 
+def get_yolo_label(class_id, positions):
+    return "\n".join((f"{class_id} {format(x, '.6f')} {format(y, '.6f')} {format(w, '.6f')} {format(h, '.6f')}" for x, y, w, h in positions))
+
+
 def write_yolo_label_image(filename, class_id, positions):
-    text = "\n".join((f"{class_id} {format(x, '.6f')} {format(y, '.6f')} {format(w, '.6f')} {format(h, '.6f')}" for x, y, w, h in positions))
     with open(filename, "w") as file:
-        file.write(text)
+        file.write(get_yolo_label(class_id, positions))
 
 
 def create_archive(directory, filename):
     import tarfile
+    import tqdm
     with tarfile.open(os.path.join(directory, f"{filename}.tar.gz"), "w:gz") as tar:
         for file in tqdm.tqdm(os.listdir(directory)):
             filepath = os.path.join(directory, file)
@@ -0,0 +1,161 @@
+import config
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock, Thread
+from time import perf_counter
+from urllib.parse import urlsplit
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+def format_labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+class Counter:
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.values = {}
+        self.lock = Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return sorted(self.values.items())
+
+    def exposition(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in self.snapshot():
+            lines.append(f"{self.name}{format_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.series = {}  # labels -> [bucket counts, sum, count, max]
+        self.lock = Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.setdefault(key, [[0] * len(self.buckets), 0.0, 0, 0.0])
+            i = bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+            series[3] = max(series[3], value)
+
+    def snapshot(self):
+        with self.lock:
+            return sorted((key, (list(s[0]), s[1], s[2], s[3])) for key, s in self.series.items())
+
+    def exposition(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count, maximum) in self.snapshot():
+            cumulative = 0
+            for le, c in zip(self.buckets, counts):
+                cumulative += c
+                lines.append(f"{self.name}_bucket{format_labels(key, le=le)} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(key, le='+Inf')} {count}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(key)} {count}")
+        return lines
+
+
+# Metrics of the bot
+stage_seconds = Histogram("spoilersbot_stage_seconds", "Latency of crawl stages in seconds")
+spoilers_total = Counter("spoilersbot_spoilers_total", "New spoilers detected by source")
+dedup_checks_total = Counter("spoilersbot_dedup_checks_total", "Images checked against spoiled images")
+dedup_hits_total = Counter("spoilersbot_dedup_hits_total", "Images found to be duplicates of spoiled images")
+dedup_cache_hits_total = Counter("spoilersbot_dedup_cache_hits_total",
+                                 "Images seen again, answered by the decision cache")
+http_failures_total = Counter("spoilersbot_http_failures_total", "HTTP requests answered with an error, by host")
+all_metrics = [stage_seconds, spoilers_total, dedup_checks_total, dedup_hits_total, dedup_cache_hits_total,
+               http_failures_total]
+
+
+def count_http_failure(url):
+    http_failures_total.inc(host=urlsplit(url).netloc)
+
+
+class timed:
+    """Observe duration of a stage, usable as decorator or context manager"""
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        stage_seconds.observe(perf_counter() - self.start, stage=self.stage)
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(self.stage):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def exposition():
+    """All metrics in prometheus text format"""
+    return "\n".join(line for metric in all_metrics for line in metric.exposition()) + "\n"
+
+
+def summary():
+    """Short human readable report for the /stats command"""
+    lines = ["<b>Stages</b> (calls, mean, max)"]
+    for key, (counts, total, count, maximum) in stage_seconds.snapshot():
+        lines.append(f"{dict(key)['stage']}: {count}, {total / count * 1000:.0f} ms, {maximum * 1000:.0f} ms")
+    lines.append("<b>Spoilers</b>")
+    for key, value in spoilers_total.snapshot():
+        lines.append(f"{dict(key)['source']}: {value}")
+    checks = sum(value for key, value in dedup_checks_total.snapshot())
+    hits = sum(value for key, value in dedup_hits_total.snapshot())
+    lines.append(f"<b>Duplicates</b>: {hits}/{checks} ({hits / checks * 100 if checks else 0:.0f}%)")
+    cached = sum(value for key, value in dedup_cache_hits_total.snapshot())
+    lines.append(f"<b>Decision cache hits</b>: {cached}")
+    failures = ", ".join(f"{dict(key)['host']}: {value}" for key, value in http_failures_total.snapshot())
+    lines.append(f"<b>HTTP failures</b>: {failures or 'none'}")
+    return "\n".join(lines)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        content = exposition().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(port, host="0.0.0.0"):
+    """Serve metrics on http://host:port/metrics from a daemon thread"""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    Thread(target=server.serve_forever, name="Metrics", daemon=True).start()
+    config.bot_logger.info(f"Metrics served on port {port}")
+    return server
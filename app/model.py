@@ -1,14 +1,63 @@
-from datetime import datetime
+import os
+import socket
+from datetime import datetime, timedelta
 from enum import Enum, auto
 import scryfall
 import config
 import logging
-from sqlalchemy import Column, Integer, String, DateTime, create_engine, BLOB
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Boolean, UniqueConstraint, create_engine, event, inspect, or_, LargeBinary
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker, relationship, scoped_session
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.sql.schema import ForeignKey
 from sqlalchemy.ext.declarative import declarative_base
 
-engine = create_engine(config.db, connect_args={'check_same_thread': False})
+# SQLite storage profile, applied to every new connection:
+# WAL lets the dispatcher thread read while the crawler writes, NORMAL sync is safe with WAL,
+# mmap speeds up the startup scan and busy_timeout makes concurrent writers wait instead of failing.
+sqlite_pragmas = {"journal_mode": "WAL",
+                  "synchronous": "NORMAL",
+                  "mmap_size": 268435456,  # 256 MB
+                  "busy_timeout": 5000,  # ms
+                  "foreign_keys": "ON"}
+
+# Connection pool used by every thread of one worker process
+pool_size = 5
+max_overflow = 5
+# Identify this process when several workers share the same database
+worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in sqlite_pragmas.items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
+
+def create_db_engine(url):
+    """
+    Create engine for any SQLAlchemy database url (sqlite:///..., postgresql://...)
+    :param url: database url, usually config.db
+    :return: SQLAlchemy engine with a connection pool
+    """
+    if url.startswith("sqlite"):
+        db_engine = create_engine(url,
+                                  connect_args={'check_same_thread': False},
+                                  poolclass=QueuePool,
+                                  pool_size=pool_size,
+                                  max_overflow=max_overflow)
+        event.listen(db_engine, "connect", set_sqlite_pragmas)
+    else:
+        # Server databases may drop idle connections, check them before use
+        db_engine = create_engine(url,
+                                  pool_size=pool_size,
+                                  max_overflow=max_overflow,
+                                  pool_pre_ping=True)
+    return db_engine
+
+
+engine = create_db_engine(config.db)
 Base = declarative_base()
 
 
@@ -34,15 +83,25 @@ class Image(Base):
     __tablename__ = 'image'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    location = Column(String)
-    descr = Column(BLOB)
+    location = Column(String, index=True)
+    descr = Column(LargeBinary)  # BLOB on SQLite, BYTEA on PostgreSQL
+    phash = Column(BigInteger)  # 64 bits perceptual hash of the illustration, signed
     conf = Column(Integer)
+    file_id = Column(String)  # Telegram file_id of the sent photo, reused instead of uploading again
+    box = Column(String)  # Crop of a card in the image at location, "x1,y1,x2,y2" relative to its size
+    descr_version = Column(Integer, index=True)  # im_utils.descriptor_version of descr and phash, NULL before
 
     spoiler = relationship("Spoiler", uselist=False)
 
-    def __init__(self, location: str, descr=None):
+    # Card crop (open_cv array) kept in memory until sent and its yolo confidence, not stored in db
+    cv_array = None
+    detection_conf = None
+
+    def __init__(self, location: str, descr=None, phash=None, descr_version=None):
         self.location = location
         self.descr = descr
+        self.phash = phash
+        self.descr_version = descr_version
         self.cv_array = None
 
     def __repr__(self):
@@ -54,23 +113,87 @@ class Spoiler(Base):
     __tablename__ = 'spoiler'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    found_at = Column(DateTime, default=datetime.now())
+    found_at = Column(DateTime, default=datetime.now(), index=True)
     url = Column(String)
     source = Column(String)  # Domain
-    source_id = Column(String)  # Reddit or scryfall id
+    source_id = Column(String, index=True)  # Reddit or scryfall id
+    name = Column(String)  # Card name when the source gives it (scryfall name, mythicspoiler page name)
     file_type = Column(String)  # Image / Video / Article
 
     image_id = Column(Integer, ForeignKey("image.id"))
     image = relationship(Image, uselist=False)
 
-    set_code = Column(String, ForeignKey("set.code"))
+    set_code = Column(String, ForeignKey("set.code"), index=True)
     set = relationship(Set, uselist=False)
 
+    # Found by a node which is not the leader, waiting to be published by the leader
+    pending = Column(Boolean, default=False, index=True)
+
     def __repr__(self):
         return f"<Spoiler(id={self.id}, found_at={self.found_at}, url={self.url}, file_type={self.file_type}, "\
                f"source_id={self.source_id}, image_id={self.image_id}, set_code={self.set_code})>"
 
 
+class CrawlItem(Base):
+    """
+    Unit of crawl work found on a source (scryfall card id, mythicspoiler image url, reddit submission id).
+    The unique constraint makes concurrent registration of the same item by several workers safe.
+    """
+
+    __tablename__ = 'crawl_item'
+    __table_args__ = (UniqueConstraint('source', 'key'),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    source = Column(String, nullable=False)
+    key = Column(String, nullable=False)
+    status = Column(String, default="pending", index=True)  # CrawlStatus value
+    worker = Column(String)
+    claimed_at = Column(DateTime)
+
+    def __repr__(self):
+        return f"<CrawlItem(id={self.id}, source={self.source}, key={self.key}, status={self.status}, "\
+               f"worker={self.worker})>"
+
+
+class Subscription(Base):
+    """Chat receiving spoilers, only those of set_code and/or source when set (None matches everything)"""
+
+    __tablename__ = 'subscription'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(BigInteger, nullable=False, index=True)
+    set_code = Column(String, ForeignKey("set.code"))
+    source = Column(String)  # SpoilerSource value
+
+    def __repr__(self):
+        return f"<Subscription(id={self.id}, chat_id={self.chat_id}, set_code={self.set_code}, source={self.source})>"
+
+
+class Node(Base):
+    """Bot process sharing the database, alive as long as its heartbeat is recent"""
+
+    __tablename__ = 'node'
+
+    id = Column(String, primary_key=True)  # worker_id
+    heartbeat_at = Column(DateTime, index=True)
+
+    def __repr__(self):
+        return f"<Node(id={self.id}, heartbeat_at={self.heartbeat_at})>"
+
+
+class Lease(Base):
+    """Named lease held by one node until it expires, used for leader election"""
+
+    __tablename__ = 'lease'
+
+    name = Column(String, primary_key=True)
+    holder = Column(String)
+    expires_at = Column(DateTime)
+
+    def __repr__(self):
+        return f"<Lease(name={self.name}, holder={self.holder}, expires_at={self.expires_at})>"
+
+
 class SpoilerSource(Enum):
     REDDIT = "Reddit"  # "https://www.reddit.com/"
     SCRYFALL = "Scryfall"  # "https://scryfall.com/"
@@ -83,6 +206,12 @@ class FileType(Enum):
     ARTICLE = auto()
 
 
+class CrawlStatus(Enum):
+    PENDING = "pending"
+    CLAIMED = "claimed"
+    DONE = "done"
+
+
 def import_scryfall_set(s, digital=None):
     local_session = Session()
     """Import scryfall Set to db, set digital to None to import all Sets"""
@@ -103,12 +232,153 @@ def update_sets():
     for s in sets:
         if import_scryfall_set(s):
             s_cpt += 1
+    try:
+        local_session.commit()
+    except IntegrityError:
+        # Another worker imported the same sets meanwhile
+        local_session.rollback()
+
+
+def subscribe(chat_id, set_code=None, source=None):
+    """
+    Subscribe a chat to spoilers
+    :return: True if the subscription is new
+    """
+    local_session = Session()
+    exists = local_session.query(Subscription).filter(Subscription.chat_id == chat_id,
+                                                      Subscription.set_code == set_code,
+                                                      Subscription.source == source).first()
+    if exists:
+        return False
+    local_session.add(Subscription(chat_id=chat_id, set_code=set_code, source=source))
+    local_session.commit()
+    return True
+
+
+def unsubscribe(chat_id):
+    """
+    Remove all subscriptions of a chat
+    :return: number of removed subscriptions
+    """
+    local_session = Session()
+    count = local_session.query(Subscription).filter(Subscription.chat_id == chat_id).delete()
     local_session.commit()
+    return count
+
+
+def claim_candidates(local_session, source: SpoilerSource, keys, claimable):
+    """
+    :return: list of (id, key) of the items of keys matching claimable, rows are locked and skipped by other
+    workers until the end of the transaction on databases supporting SELECT ... FOR UPDATE SKIP LOCKED
+    """
+    query = local_session.query(CrawlItem.id, CrawlItem.key)\
+        .filter(CrawlItem.source == source.value, CrawlItem.key.in_(keys), claimable)
+    if local_session.get_bind().dialect.name == "postgresql":
+        query = query.with_for_update(skip_locked=True, of=CrawlItem)
+    return query.all()
+
+
+def claim_items(source: SpoilerSource, keys, worker=worker_id, timeout=timedelta(minutes=30)):
+    """
+    Register items found on a source then claim those no other worker holds.
+    Each item is claimed by an UPDATE conditioned on its status, so when two workers read the same claimable item
+    only one of them updates it. PostgreSQL also locks the read rows with SKIP LOCKED so workers don't wait on them.
+    :param source: SpoilerSource of the items
+    :param keys: list of item keys found on the source
+    :param worker: id of the claiming worker
+    :param timeout: items claimed for longer than this by a worker which never finished them can be claimed again
+    :return: list of claimed keys, to be processed by this worker only
+    """
+    keys = list(keys)
+    if not keys:
+        return []
+    # Use a dedicated session so rollbacks don't touch the thread scoped session
+    local_session = session_factory()
+    try:
+        known = {i.key for i in local_session.query(CrawlItem.key)
+                 .filter(CrawlItem.source == source.value, CrawlItem.key.in_(keys))}
+        for key in keys:
+            if key in known:
+                continue
+            local_session.add(CrawlItem(source=source.value, key=key, status=CrawlStatus.PENDING.value))
+            try:
+                local_session.commit()
+            except IntegrityError:
+                # Registered meanwhile by another worker
+                local_session.rollback()
+        now = datetime.now()
+        stale = (CrawlItem.status == CrawlStatus.CLAIMED.value) & (CrawlItem.claimed_at < now - timeout)
+        claimable = or_(CrawlItem.status == CrawlStatus.PENDING.value, stale)
+        claimed = []
+        for item_id, key in claim_candidates(local_session, source, keys, claimable):
+            result = local_session.execute(CrawlItem.__table__.update()
+                                           .where((CrawlItem.id == item_id) & claimable)
+                                           .values(status=CrawlStatus.CLAIMED.value, worker=worker, claimed_at=now))
+            # No row updated when another worker claimed the item since it was read
+            if result.rowcount == 1:
+                claimed.append(key)
+        local_session.commit()
+        return claimed
+    finally:
+        local_session.close()
+
+
+def finish_items(source: SpoilerSource, keys):
+    """Mark claimed items as done once processed"""
+    keys = list(keys)
+    if not keys:
+        return
+    local_session = session_factory()
+    try:
+        local_session.query(CrawlItem)\
+            .filter(CrawlItem.source == source.value, CrawlItem.key.in_(keys))\
+            .update({CrawlItem.status: CrawlStatus.DONE.value}, synchronize_session=False)
+        local_session.commit()
+    finally:
+        local_session.close()
+
+
+def done_items(source: SpoilerSource, keys):
+    """
+    :return: list of keys already processed by a worker, among keys
+    """
+    keys = list(keys)
+    if not keys:
+        return []
+    local_session = session_factory()
+    try:
+        return [i.key for i in local_session.query(CrawlItem.key)
+                .filter(CrawlItem.source == source.value, CrawlItem.key.in_(keys),
+                        CrawlItem.status == CrawlStatus.DONE.value)]
+    finally:
+        local_session.close()
+
+
+def migrate():
+    """
+    Bring an existing database up to date with the models, safe to run on every start.
+    create_all only creates missing tables, so columns and indexes declared on existing tables are added here.
+    Added columns are left NULL on existing rows.
+    """
+    Base.metadata.create_all(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            columns = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns:
+                    connection.execute(f"ALTER TABLE {quote(table.name)} "
+                                       f"ADD COLUMN {quote(column.name)} {column.type.compile(engine.dialect)}")
+            for index in table.indexes:
+                columns = ", ".join(quote(c.name) for c in index.columns)
+                connection.execute(f"CREATE INDEX IF NOT EXISTS {quote(index.name)} "
+                                   f"ON {quote(table.name)} ({columns})")
 
 
-Base.metadata.create_all(engine)
 session_factory = sessionmaker(bind=engine)
 Session = scoped_session(session_factory)
 
 if __name__ == "__main__":
+    migrate()
     update_sets()
@@ -1,15 +1,103 @@
-import os
 import re
+import hashlib
 import requests
-from bs4 import BeautifulSoup, Comment, Tag, NavigableString
+import metrics
+from time import monotonic
+from html.parser import HTMLParser
+from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor
+
+
+class StopParsing(Exception):
+    pass
+
+
+class CardLinkParser(HTMLParser):
+    """
+    Streaming extraction of card links: (href, src of the first image inside the link) of <a> whose href
+    matches href_reg. No tree is built, and parsing stops after stop_after consecutive known images.
+    """
+
+    def __init__(self, href_reg, known=(), base_url="", stop_after=5):
+        """
+        :param known: image urls already seen, base_url + src
+        """
+        super().__init__()
+        self.href_reg = href_reg
+        self.known = known
+        self.base_url = base_url
+        self.stop_after = stop_after
+        self.known_in_row = 0
+        self.links = []
+        self.href = None
+        self.src = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "a":
+            self.end_link()
+            href = dict(attrs).get("href")
+            if href and self.href_reg.search(href):
+                self.href = href.replace("\n", "")
+        elif tag == "img" and self.href is not None and self.src is None:
+            self.src = (dict(attrs).get("src") or "").replace("\n", "")
+
+    def handle_endtag(self, tag):
+        if tag == "a":
+            self.end_link()
+
+    def end_link(self):
+        if self.href is None:
+            return
+        src = self.src
+        self.links.append((self.href, src))
+        self.href, self.src = None, None
+        if src and self.base_url + src in self.known:
+            self.known_in_row += 1
+            if self.known_in_row >= self.stop_after:
+                raise StopParsing
+        else:
+            self.known_in_row = 0
+
+    def parse(self, text):
+        try:
+            self.feed(text)
+            self.close()
+        except StopParsing:
+            pass
+        return self.links
+
+
+class CardInfoParser(HTMLParser):
+    """Streaming extraction of the text following each card info comment (<!--CARD NAME-->...)"""
+
+    def __init__(self, card_types):
+        super().__init__()
+        self.card_types = card_types
+        self.infos = {}
+        self.current = None
+
+    def handle_comment(self, data):
+        self.current = self.card_types.get(data)
+        if self.current:
+            self.infos[self.current] = ""
+
+    def handle_data(self, data):
+        if self.current:
+            self.infos[self.current] += data
 
 
 class MythicSpoiler:
     """Class specifically designed to extract card and set info on mythicspoiler.com"""
 
     url = "https://mythicspoiler.com/"
-    page_reg = r'cards\/.*\.html|jpg|png$'  # reg to find all card pages
-    img_reg = r'cards\/.*\.jpg|png$'  # reg to find all card images
+    page_reg = re.compile(r'cards\/.*\.html|jpg|png$')  # reg to find all card pages
+    img_reg = re.compile(r'cards\/.*\.jpg|png$')  # reg to find all card images
+    expansion_reg = re.compile(r'^(.*)\/cards\/')  # expansion of a card page
+    card_text_reg = re.compile(r"<!--CARD TEXT-->.*<!--END CARD TEXT-->", re.DOTALL)
+    newlines_reg = re.compile(r'\n+')
+    # Scryfall set types having a gallery page, tokens, promos or art series don't
+    gallery_set_types = ("core", "expansion", "masters", "draft_innovation", "commander")
+    missing_retry = 6 * 3600  # Seconds before fetching again a page which didn't exist
     # Card types figuring on card page:
     card_types = {"CARD NAME": "name",
                   "MANA COST": "cmc",
@@ -20,93 +108,118 @@ class MythicSpoiler:
                   "Set Number": "set_num",
                   "P/T": "p/t"}
 
-    def get_cards_from_news(self):
+    def __init__(self, workers=4):
+        """
+        :param workers: number of set pages fetched in parallel
+        """
+        self.workers = workers
+        # Validators and content hash of fetched set pages by url, to skip unchanged pages
+        self.fingerprints = {}
+        # Time pages were found missing by url, skipped until missing_retry
+        self.missing = {}
+
+    def get_cards_from_news(self, known=()):
         """
         Fetch /newspoilers.html and return all cards
+        :param known: card image urls already seen, parsing stops after a few of them in a row
+        (the newest cards are first)
         :return: list of tuple (card_url, card_image_url, expansion)
         """
         r = requests.get(self.url + "newspoilers.html")
-        if r.ok:
-            soup = BeautifulSoup(r.text, 'html.parser')
-        else:
+        if not r.ok:
+            metrics.count_http_failure(r.url)
             return []
-        tags = soup.find_all('a', {'href': re.compile(self.page_reg)})
+        return self.parse_news(r.text, known)
+
+    def parse_news(self, text, known=()):
         cards = []
-        for tag in tags:
-            page = self.url + tag.get("href", "").replace("\n", "")
-            image_url = None
-            if ".html" not in os.path.splitext(tag.get("href"))[1]:
-                page = None
-            if tag.img:
-                image_url = self.url + tag.img.get("src", "").replace("\n", "")
-            if page:
-                reg = re.compile("https://mythicspoiler\.com\/(.*)\/cards/")
-                match = reg.findall(page)
-                if len(match):
-                    expansion = match[0]
-                else:
-                    expansion = None
-            if image_url:
-                cards.append((page, image_url, expansion))
+        for href, src in CardLinkParser(self.page_reg, known, base_url=self.url).parse(text):
+            if not src:
+                continue
+            page = self.url + href if href.endswith(".html") else None
+            match = self.expansion_reg.match(href)
+            cards.append((page, self.url + src, match.group(1) if match else None))
         return cards
 
+    def get_changed_page(self, url):
+        """
+        Fetch a page, conditionally when it was already fetched
+        :return: tuple (final url, text), text is None when the page didn't change since the last fetch
+        or doesn't exist
+        """
+        if monotonic() - self.missing.get(url, -self.missing_retry) < self.missing_retry:
+            return url, None
+        etag, last_modified, digest = self.fingerprints.get(url, (None, None, None))
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        r = requests.get(url, headers=headers)
+        if r.status_code == requests.codes.not_modified:
+            return r.url, None
+        if r.status_code == requests.codes.not_found:
+            # Expected for sets without gallery yet, not a failure
+            self.missing[url] = monotonic()
+            return r.url, None
+        self.missing.pop(url, None)
+        if not r.ok:
+            metrics.count_http_failure(r.url)
+            return r.url, None
+        # Servers without validators: compare content
+        new_digest = hashlib.sha1(r.content).digest()
+        self.fingerprints[url] = (r.headers.get("ETag"), r.headers.get("Last-Modified"), new_digest)
+        if new_digest == digest:
+            return r.url, None
+        return r.url, r.text
+
     def get_cards_from_set(self, set_code):
-        """ Return tuple (page_url, image_url)
-            page_url = mythicspoiler page url for this card if not : None
-            image_url = link to card image
+        """
+        Fetch the gallery page of a set and return its cards, nothing if the page didn't change since the last call
+        :return: list of tuple (card_url, card_image_url, expansion), card_url is None if the card has no page
         """
         set_code = set_code.lower()
-        r = requests.get(self.url + set_code)
-        if r.ok:
-            soup = BeautifulSoup(r.text, 'html.parser')
-        else:
+        page_url, text = self.get_changed_page(self.url + set_code)
+        if text is None:
             return []
-        tags = soup.find_all('a', {'href': re.compile(self.page_reg)})
         cards = []
-        for tag in tags:
-            page = os.path.join(set_code, tag.get("href"))
-            if not os.path.splitext(tag.get("href"))[1] == ".html":
-                page = None
-            image_url = tag.img.get("src")
-            cards.append((page, image_url))
+        for href, src in CardLinkParser(self.page_reg).parse(text):
+            if not src:
+                continue
+            page = urljoin(page_url, href) if href.endswith(".html") else None
+            cards.append((page, urljoin(page_url, src), set_code))
         return cards
 
+    def get_cards_from_sets(self, set_codes):
+        """Cards of the changed gallery pages of several sets, fetched in parallel"""
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return [card for cards in executor.map(self.get_cards_from_set, set_codes) for card in cards]
+
+    @staticmethod
+    def get_card_name(page):
+        """Card name from its page url, pages are named after the card: .../cards/goldspandragon.html"""
+        if not page:
+            return None
+        return page.rsplit("/", 1)[-1].rsplit(".", 1)[0]
+
     def get_card_info(self, card_url):
         """Extract card info from card url (mythicspoiler)"""
-        infos = {}
-        # Extract only html containing card info
-        reg = r"<!--CARD TEXT-->(\n|.)*<!--END CARD TEXT-->"
         r = requests.get(self.url + card_url)
-        if r.ok:
-            p = re.compile(reg)
-            result = p.search(r.text)
-            if result:
-                text = result.group(0)
-            else:
-                return None
-
-        soup = BeautifulSoup(text, 'html.parser')
-        # Remove br elements
-        for e in soup.findAll('br'):
-            e.extract()
-        for c in soup.contents:
-            if isinstance(c, Tag):
-                comments = c.findAll(text=lambda t: isinstance(t, Comment))
-                for comment in comments:
-                    if comment in self.card_types.keys():
-                        info = ""
-                        v = comment.next_element
-                        # Sometimes one info is spread between multiple NavigableString
-                        while isinstance(v, NavigableString) \
-                                and "END CARD" not in v.string \
-                                and v.string not in self.card_types.keys():
-                            info += re.sub(pattern=r'(^(?:\\n)+|(?:\\n)+$)', repl='', string=v.string)
-                            v = v.next_element
-                        # prettify result
-                        info = re.sub(pattern=r'(^(?:\n)+|(?:\n)+$)', repl='', string=info.strip())
-                        info = re.sub(pattern=r'(\n)+', repl='\n', string=info)
-                        infos[self.card_types[comment]] = info
-        return infos
+        if not r.ok:
+            metrics.count_http_failure(r.url)
+            return None
+        return self.parse_card_info(r.text)
+
+    def parse_card_info(self, text):
+        # Extract only html containing card info
+        result = self.card_text_reg.search(text)
+        if not result:
+            return None
+        parser = CardInfoParser(self.card_types)
+        parser.feed(result.group(0))
+        parser.close()
+        # prettify result
+        return {key: self.newlines_reg.sub("\n", info.strip()) for key, info in parser.infos.items()}
 
 
 if __name__ == "__main__":
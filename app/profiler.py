@@ -0,0 +1,129 @@
+import os
+import sys
+import html
+import threading
+from collections import Counter
+from time import sleep, perf_counter
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}"
+
+
+class SamplingProfiler:
+    """
+    Sample the stack of the crawl thread at a fixed interval for some crawl cycles.
+    Only the thread running a profiled cycle is sampled, so other threads (polling, publisher) cost nothing.
+    Stacks are kept in collapsed format ("a;b;c count"), the input of flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval=0.005):
+        """
+        :param interval: seconds between two samples
+        """
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.remaining = 0
+        self.on_done = None
+        self.thread_id = None
+        self.stacks = Counter()
+        self.started_at = None
+        self.sampler = None
+
+    @property
+    def running(self):
+        return self.remaining > 0
+
+    def start(self, cycles, on_done):
+        """
+        Profile the next crawl cycles
+        :param cycles: number of cycles to profile
+        :param on_done: called with the profiler once the cycles are done
+        :return: False if a profile is already running
+        """
+        with self.lock:
+            if self.running:
+                return False
+            self.remaining = cycles
+            self.on_done = on_done
+            self.stacks = Counter()
+            self.started_at = None
+            return True
+
+    def cycle(self):
+        """Context manager around a crawl cycle, samples it when a profile is running"""
+        return ProfiledCycle(self)
+
+    def enter(self):
+        with self.lock:
+            if not self.running or self.thread_id is not None:
+                return False
+            self.thread_id = threading.get_ident()
+            if self.started_at is None:
+                self.started_at = perf_counter()
+            self.sampler = threading.Thread(target=self.sample, args=(self.thread_id,), name="Profiler", daemon=True)
+            self.sampler.start()
+            return True
+
+    def exit(self):
+        with self.lock:
+            self.thread_id = None
+            self.remaining -= 1
+            done = not self.running
+        self.sampler.join()
+        if done:
+            self.on_done(self)
+
+    def sample(self, thread_id):
+        while self.thread_id == thread_id:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            sleep(self.interval)
+
+    def collapsed(self):
+        """Sampled stacks in collapsed format, one "frame;frame;frame count" line per stack"""
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + "\n"
+
+    def top_functions(self, limit=15):
+        """
+        :return: list of tuple (function, self samples, total samples), sorted by total samples
+        """
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            # Drop line numbers, a function counts once per stack even if recursive
+            functions = [frame.rsplit(":", 1)[0] for frame in stack.split(";")]
+            own[functions[-1]] += count
+            for function in set(functions):
+                total[function] += count
+        return [(function, own[function], count) for function, count in total.most_common(limit)]
+
+    def summary(self, limit=15):
+        samples = sum(self.stacks.values()) or 1
+        elapsed = perf_counter() - self.started_at if self.started_at else 0
+        lines = [f"<b>Profile</b>: {samples} samples in {elapsed:.1f}s (self %, total %)"]
+        for function, own, total in self.top_functions(limit):
+            lines.append(f"<code>{html.escape(function)}</code> "
+                         f"{own / samples * 100:.0f}%, {total / samples * 100:.0f}%")
+        return "\n".join(lines)
+
+
+class ProfiledCycle:
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.profiled = False
+
+    def __enter__(self):
+        self.profiled = self.profiler.enter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profiled:
+            self.profiler.exit()
@@ -0,0 +1,192 @@
+import config
+import metrics
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from threading import Thread, Lock
+from time import monotonic, sleep
+from telegram import InputMediaPhoto
+from telegram.error import RetryAfter, TimedOut, NetworkError, BadRequest, TelegramError
+
+
+class TokenBucket:
+    """Thread safe token bucket, consume blocks until enough tokens are available"""
+
+    def __init__(self, rate, capacity):
+        """
+        :param rate: tokens added per second
+        :param capacity: maximum number of tokens, allowed burst
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = monotonic()
+        self.lock = Lock()
+
+    def consume(self, tokens=1):
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            sleep(wait)
+
+
+class Publication:
+    """Photos to send to one chat, as a single photo or as an album, then to followers chats"""
+
+    def __init__(self, chat_id, photos, keys=None, on_sent=None, followers=()):
+        """
+        :param chat_id: telegram chat id
+        :param photos: list of tuple (photo, caption), photo is an url, a file like object, a telegram file_id
+        or a function returning one, called by the sender thread
+        :param keys: list of keys identifying each photo for on_sent
+        :param on_sent: function called with keys and telegram file_ids of the photos once sent
+        :param followers: other chat ids receiving the photos, with the file_ids of the first upload
+        """
+        self.chat_id = chat_id
+        self.photos = photos
+        self.keys = keys
+        self.on_sent = on_sent
+        self.followers = followers
+
+    def __repr__(self):
+        return f"<Publication(chat_id={self.chat_id}, photos={len(self.photos)}, followers={len(self.followers)})>"
+
+
+class Publisher:
+    """
+    Queue of publications sent by a dedicated thread, so crawling never waits on telegram.
+    Sends follow telegram limits (https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this):
+    about 30 messages per second overall and 20 messages per minute in the same group.
+    """
+
+    album_size = 10  # Maximum number of photos in a telegram media group
+    max_retries = 5
+    fan_out_workers = 8  # Concurrent sends to followers, all still share the global limit
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.queue = Queue()
+        self.pool = ThreadPoolExecutor(max_workers=self.fan_out_workers, thread_name_prefix="FanOut")
+        self.bucket = TokenBucket(rate=30, capacity=30)
+        self.chat_buckets = {}
+        self.thread = Thread(target=self.run, name="Publisher", daemon=True)
+        self.thread.start()
+
+    def publish(self, chat_ids, photos, keys=None, on_sent=None):
+        """
+        Queue photos for chats, several photos are grouped in albums.
+        Photos are uploaded once to the first chat then sent to the others with their telegram file_ids.
+        If the upload to a chat fails, the next chat uploads them, a failing channel doesn't stop subscribers.
+        :param chat_ids: list of telegram chat ids
+        :param photos: list of tuple (photo, caption)
+        :param keys: list of keys identifying each photo for on_sent
+        :param on_sent: function called with keys and telegram file_ids of the photos once sent
+        """
+        if not chat_ids:
+            return
+        chat_id, *followers = chat_ids
+        for i in range(0, len(photos), self.album_size):
+            self.queue.put(Publication(chat_id,
+                                       photos[i:i + self.album_size],
+                                       keys[i:i + self.album_size] if keys else None,
+                                       on_sent,
+                                       followers))
+
+    def run(self):
+        while True:
+            publication = self.queue.get()
+            try:
+                self.send(publication)
+            except Exception as e:
+                # Keep the sender alive whatever happens
+                config.bot_logger.error(f"Failed to send {publication}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def get_chat_bucket(self, chat_id):
+        return self.chat_buckets.setdefault(chat_id, TokenBucket(rate=20 / 60, capacity=20))
+
+    def send(self, publication: Publication):
+        # Photos to download or crop are prepared here, not in the crawl thread
+        publication.photos = [(photo() if callable(photo) else photo, caption)
+                              for photo, caption in publication.photos]
+        messages = self.send_with_retries(publication)
+        while messages is None and publication.followers:
+            # Followers don't depend on the first chat: upload to the next one, the others get its file_ids
+            chat_id, *followers = publication.followers
+            config.bot_logger.info(f"Upload {publication} to chat {chat_id} instead.")
+            publication = Publication(chat_id, publication.photos, publication.keys, publication.on_sent, followers)
+            messages = self.send_with_retries(publication)
+        if messages is None:
+            return None
+        file_ids = self.get_file_ids(messages)
+        if publication.on_sent:
+            publication.on_sent(publication.keys, file_ids)
+        if publication.followers:
+            self.fan_out(publication, file_ids)
+        return messages
+
+    def send_with_retries(self, publication: Publication):
+        """
+        Send a publication to its chat, waiting on flood control and retrying network errors
+        :return: sent messages, None if telegram refused them or all attempts failed
+        """
+        chat_bucket = self.get_chat_bucket(publication.chat_id)
+        for attempt in range(self.max_retries):
+            # An album counts as one message per photo
+            chat_bucket.consume(len(publication.photos))
+            self.bucket.consume(len(publication.photos))
+            try:
+                return self.send_now(publication)
+            except RetryAfter as e:
+                config.bot_logger.info(f"Telegram flood control, retry {publication} in {e.retry_after}s.")
+                sleep(e.retry_after)
+            except BadRequest as e:
+                # A NetworkError subclass, but sending the same photo again fails the same way
+                config.bot_logger.error(f"Telegram refused {publication}: {e}")
+                return None
+            except (TimedOut, NetworkError) as e:
+                config.bot_logger.info(f"Telegram {e}, retry {publication}.")
+                sleep(2 ** attempt)
+            except TelegramError as e:
+                config.bot_logger.error(f"Telegram refused {publication}: {e}")
+                return None
+        config.bot_logger.error(f"Gave up sending {publication} after {self.max_retries} attempts.")
+        return None
+
+    def fan_out(self, publication: Publication, file_ids):
+        """Send already uploaded photos to followers chats concurrently"""
+        # Followers are sent concurrently, they get a copy of file objects never uploaded
+        photos = [(file_id or (photo.getvalue() if hasattr(photo, "getvalue") else photo), caption)
+                  for (photo, caption), file_id in zip(publication.photos, file_ids)]
+        for chat_id in publication.followers:
+            self.pool.submit(self.send, Publication(chat_id, photos))
+
+    @metrics.timed("send")
+    def send_now(self, publication: Publication):
+        for photo, caption in publication.photos:
+            # File objects were read by the previous attempt
+            if hasattr(photo, "seek"):
+                photo.seek(0)
+        if len(publication.photos) == 1:
+            photo, caption = publication.photos[0]
+            return self.bot.send_photo(chat_id=publication.chat_id,
+                                       photo=photo,
+                                       caption=caption,
+                                       parse_mode="HTML")
+        media = [InputMediaPhoto(media=photo, caption=caption, parse_mode="HTML")
+                 for photo, caption in publication.photos]
+        return self.bot.send_media_group(chat_id=publication.chat_id, media=media)
+
+    @staticmethod
+    def get_file_ids(messages):
+        """Return telegram file_id of the largest size of each sent photo"""
+        if not isinstance(messages, list):
+            messages = [messages]
+        return [m.photo[-1].file_id if m and m.photo else None for m in messages]
@@ -1,4 +1,5 @@
 import config
+import html
 import praw
 
 
@@ -17,6 +18,37 @@ class Reddit:
         if subreddit:
             self.subreddit = self.reddit.subreddit(subreddit)
 
+    @staticmethod
+    def get_images(submission, pixel_budget=None):
+        """
+        Images of a gallery or link submission
+        :param pixel_budget: pick the smallest preview with at least this number of pixels, the largest preview if
+        none has enough, source if None
+        :return: list of tuple (url of the picked resolution, url of the source resolution)
+        """
+        # Resolutions of each image as tuples (url, width, height), source first
+        variants = []
+        if hasattr(submission, "is_gallery"):
+            for value in (submission.media_metadata or {}).values():
+                if value.get("s", {}).get("u"):
+                    variants.append([(r.get("u"), r.get("x", 0), r.get("y", 0))
+                                     for r in [value["s"]] + value.get("p", [])])
+        elif hasattr(submission, "preview"):
+            image = submission.preview.get("images", [])[0]
+            variants.append([(r.get("url"), r.get("width", 0), r.get("height", 0))
+                             for r in [image.get("source")] + image.get("resolutions", [])])
+        images = []
+        for resolutions in variants:
+            source = picked = resolutions[0]
+            previews = [r for r in resolutions[1:] if r[0]]
+            if pixel_budget and previews:
+                large = [r for r in previews if r[1] * r[2] >= pixel_budget]
+                # Previews stop at 1080 px wide, the largest one is still much lighter than the source
+                picked = min(large, key=lambda r: r[1] * r[2]) if large else max(previews, key=lambda r: r[1] * r[2])
+            # Urls of reddit json are html escaped (&amp;)
+            images.append((html.unescape(picked[0]), html.unescape(source[0])))
+        return images
+
     def search_spoilers(self):
         return self.subreddit.search('flair:"spoiler"', limit=self.search_limit)
 
@@ -0,0 +1,136 @@
+"""
+Re-describe stored images after a change of the descriptors (histogram bins, illustration boxes, phash).
+
+Images whose descr_version is not im_utils.descriptor_version are walked by id in chunks: images of a chunk are
+downloaded once into a local cache, described by a pool of processes and written back in one batched update.
+Each chunk is committed on its own, so the command can be stopped and run again, it resumes where it stopped.
+Transactions are short and chunks small, the bot can keep running on the same database.
+Reddit images stored before cards were stored with their box hold a whole gallery, they keep their descriptors.
+
+    python reprocess.py --chunk 200 --workers 2
+"""
+import os
+import argparse
+import multiprocessing
+from time import sleep, perf_counter
+from concurrent.futures import ThreadPoolExecutor
+import cv2 as cv
+import config
+import im_utils
+import model
+from sqlalchemy import or_
+from model import Image, Spoiler, SpoilerSource
+
+
+def fetch(url, cache_dir):
+    """Cached file of an image url, None if it can't be downloaded"""
+    try:
+        return im_utils.download_cached(url, cache_dir)
+    except Exception:
+        config.bot_logger.exception(f"Can't download {url}")
+        return None
+
+
+def describe_row(task):
+    """
+    Describe a stored image from its cached file, run in a worker process
+    :param task: tuple (image id, cached file path, box)
+    :return: tuple (image id, descr bytes, phash), descriptors are None if the image can't be read
+    """
+    image_id, filename, box = task
+    try:
+        cv_im = cv.imread(filename, cv.IMREAD_UNCHANGED) if filename else None
+        if cv_im is None:
+            return image_id, None, None
+        if box:
+            # Card found by yolo on a reddit image, stored as its source and the box of the card
+            if cv_im.ndim == 3 and cv_im.shape[2] == 4:
+                cv_im = cv.cvtColor(cv_im, cv.COLOR_BGRA2BGR)
+            cv_im = im_utils.crop_relative(cv_im, [float(c) for c in box.split(",")])
+        descr, phash = im_utils.describe_image(cv_im)
+    except Exception:
+        # Bad box, unreadable file... only this image fails
+        config.bot_logger.exception(f"Can't describe image {image_id} from {filename}")
+        return image_id, None, None
+    return image_id, descr.tobytes(), phash
+
+
+def stale_images(session, after_id, limit):
+    """
+    Next chunk of images described with another descriptor version, by id.
+    Reddit images without a box are skipped, their location is the whole gallery and not the card.
+    """
+    return session.query(Image.id, Image.location, Image.box)\
+        .outerjoin(Spoiler, Spoiler.image_id == Image.id)\
+        .filter(Image.id > after_id, Image.location.isnot(None),
+                (Image.descr_version.is_(None)) | (Image.descr_version != im_utils.descriptor_version),
+                or_(Image.box.isnot(None), Spoiler.source.is_(None), Spoiler.source != SpoilerSource.REDDIT.value))\
+        .order_by(Image.id).limit(limit).all()
+
+
+def reprocess(cache_dir, chunk=200, workers=2, downloads=8, pause=1.0, limit=None):
+    """
+    Recompute descriptors of every stale image
+    :param cache_dir: images are downloaded once there, a new run reads them from the cache
+    :param chunk: images read, described and updated at once
+    :param workers: number of processes describing images
+    :param downloads: number of threads downloading images
+    :param pause: seconds between two chunks, to leave the database and cpus to the bot
+    :param limit: stop after this number of images
+    :return: tuple (updated images, images which could not be read)
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    session = model.session_factory()
+    updated = failed = 0
+    after_id = 0
+    remaining = limit
+    start = perf_counter()
+    try:
+        with multiprocessing.Pool(workers) as pool, ThreadPoolExecutor(max_workers=downloads) as executor:
+            while remaining is None or remaining > 0:
+                rows = stale_images(session, after_id, chunk if remaining is None else min(chunk, remaining))
+                # End the read transaction, the bot may write while this chunk is described
+                session.commit()
+                if not rows:
+                    break
+                after_id = rows[-1].id
+                if remaining is not None:
+                    remaining -= len(rows)
+                # Cards found on the same reddit image share its location, download it once
+                locations = list({row.location for row in rows})
+                files = dict(zip(locations, executor.map(lambda url: fetch(url, cache_dir), locations)))
+                tasks = [(row.id, files[row.location], row.box) for row in rows]
+                mappings = []
+                for image_id, descr, phash in pool.imap_unordered(describe_row, tasks):
+                    if descr is None:
+                        failed += 1
+                        continue
+                    mappings.append({"id": image_id, "descr": descr, "phash": phash,
+                                     "descr_version": im_utils.descriptor_version})
+                session.bulk_update_mappings(Image, mappings)
+                session.commit()
+                updated += len(mappings)
+                config.bot_logger.info(f"Reprocessed {updated} images up to id {after_id} "
+                                       f"({updated / (perf_counter() - start):.1f}/s), {failed} unreadable")
+                sleep(pause)
+    finally:
+        session.close()
+    return updated, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recompute descriptors of stored images")
+    parser.add_argument("--chunk", type=int, default=200, help="images described and updated at once")
+    parser.add_argument("--workers", type=int, default=2,
+                        help="number of processes, keep it below the number of cpus when the bot runs on this host")
+    parser.add_argument("--downloads", type=int, default=8, help="number of download threads")
+    parser.add_argument("--pause", type=float, default=1.0, help="seconds between two chunks")
+    parser.add_argument("--limit", type=int, help="stop after this number of images")
+    parser.add_argument("--cache", default=os.path.join(config.src_dir, 'db', 'images'),
+                        help="image cache directory")
+    args = parser.parse_args()
+    model.migrate()
+    updated, failed = reprocess(args.cache, chunk=args.chunk, workers=args.workers, downloads=args.downloads,
+                                pause=args.pause, limit=args.limit)
+    print(f"Updated descriptors of {updated} images to version {im_utils.descriptor_version}, "
+          f"{failed} images could not be read")
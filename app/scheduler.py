@@ -0,0 +1,134 @@
+import config
+from threading import Lock
+from time import monotonic
+
+
+class Task:
+    """Crawl job with its own interval, adapted to the number of new items found by its last runs"""
+
+    def __init__(self, name, func, interval, min_interval=None, max_interval=None, idle_interval=None, urgent=False):
+        """
+        :param func: called with the job context, returns the number of new items found or None
+        :param interval: seconds between the end of a run and the next one
+        :param min_interval: lower bound when the source is active, fixed interval if None
+        :param max_interval: upper bound when the source is quiet or failing
+        :param idle_interval: interval out of preview season, when no futur set exists
+        :param urgent: run as soon as due, even between the tasks of a tick, for short tasks like the heartbeat
+        """
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.min_interval = min_interval or interval
+        self.max_interval = max_interval or interval
+        self.idle_interval = idle_interval
+        self.urgent = urgent
+        self.next_run = 0
+        self.wait = interval
+        self.last_duration = None
+        self.last_count = None
+        self.failures = 0
+
+    def adapt(self, count, idle):
+        """Halve the interval when new items were found, slowly increase it otherwise"""
+        if count:
+            self.interval = max(self.min_interval, self.interval / 2)
+        elif count is not None:
+            self.interval = min(self.max_interval, self.interval * 1.5)
+        interval = self.interval
+        if idle and self.idle_interval:
+            interval = max(interval, self.idle_interval)
+        return interval
+
+    def backoff(self):
+        self.failures += 1
+        return min(self.max_interval, self.interval * 2 ** self.failures)
+
+
+class CrawlScheduler:
+    """
+    Run crawl tasks from a single repeating job, one task at a time.
+    A task is only scheduled again once its run is over, and a tick finding a crawl still running is skipped,
+    so slow crawls never pile up nor run concurrently on the spoiled list.
+    """
+
+    def __init__(self, tick=5):
+        """
+        :param tick: seconds between two checks of due tasks, the interval of the repeating job
+        """
+        self.tick = tick
+        self.tasks = []
+        self.lock = Lock()
+        self.idle = False
+        self.running = None
+        self.skipped_ticks = 0
+
+    def add(self, name, func, interval, **kwargs):
+        """Add a task, due at the first tick. Tasks due at the same tick run in insertion order"""
+        task = Task(name, func, interval, **kwargs)
+        self.tasks.append(task)
+        return task
+
+    def due(self):
+        now = monotonic()
+        return [task for task in self.tasks if task.next_run <= now]
+
+    def run_due(self, context):
+        """Run every due task, unless the previous tick is still running"""
+        if not self.lock.acquire(blocking=False):
+            self.skipped_ticks += 1
+            return
+        try:
+            for task in self.due():
+                for urgent in self.due():
+                    if urgent.urgent and urgent is not task:
+                        self.run(urgent, context)
+                # Already run as an urgent task
+                if task.next_run <= monotonic():
+                    self.run(task, context)
+        finally:
+            self.lock.release()
+
+    def run_all(self, context):
+        """Run every task now whatever its schedule, for harnesses and benchmarks"""
+        with self.lock:
+            for task in self.tasks:
+                self.run(task, context)
+
+    def run(self, task, context):
+        self.running = task
+        start = monotonic()
+        try:
+            count = task.func(context)
+        except Exception:
+            config.bot_logger.exception(f"Task {task.name} failed")
+            interval = task.backoff()
+        else:
+            task.failures = 0
+            task.last_count = count
+            interval = task.adapt(count, self.idle)
+        finally:
+            self.running = None
+        end = monotonic()
+        task.last_duration = end - start
+        task.wait = interval
+        task.next_run = end + interval
+
+    def describe(self):
+        """Html report of the schedule for the /schedule command"""
+        now = monotonic()
+        lines = [f"<b>Schedule</b> ({'off season' if self.idle else 'preview season'}, "
+                 f"{self.skipped_ticks} skipped ticks)"]
+        for task in self.tasks:
+            if task is self.running:
+                state = "running"
+            else:
+                state = f"next in {max(task.next_run - now, 0):.0f}s"
+            line = f"{task.name}: every {task.wait:.0f}s, {state}"
+            if task.last_duration is not None:
+                line += f", last run {task.last_duration:.1f}s"
+            if task.last_count is not None:
+                line += f" ({task.last_count} new)"
+            if task.failures:
+                line += f", {task.failures} failures"
+            lines.append(line)
+        return "\n".join(lines)
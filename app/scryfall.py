@@ -1,6 +1,7 @@
 import requests
 import json
 import config
+import metrics
 import os
 from enum import Enum
 from urllib.parse import quote, quote_plus
@@ -16,19 +17,22 @@ class ScryfallTypes(Enum):
     UNIQUE_ART = "unique_artwork"
 
 
-def get_content(url):
-    """Extract data from API json file. If there is multiple pages, gather them."""
+def get_content(url, all_pages=True):
+    """Extract data from API json file. If there is multiple pages and all_pages, gather them."""
     if not url: return False
     # Time limit of scryfall API
     sleep(0.1)
-    r = requests.get(url)
+    with metrics.timed("get_content"):
+        r = requests.get(url)
     data = {}
-    if r.status_code == requests.codes.ok:
+    if r.status_code != requests.codes.ok:
+        metrics.count_http_failure(url)
+    else:
         data = json.loads(r.content.decode('utf-8'))
         if data.get("object", False) == "error": 
             config.bot_logger.info("API respond an error to url : {0}".format(url))
             return False
-        if data.get("has_more", None) and data.get("next_page", None):
+        if all_pages and data.get("has_more", None) and data.get("next_page", None):
             content = get_content(data["next_page"])
             data["data"] += content.get("data", [])
     return data
@@ -135,17 +139,34 @@ def get_card_by_name(name, set="", exact=True):
         return None
 
 
-def search(**kwargs):
-    """General search using scryfall search engine"""
+def get_search_url(order=None, **kwargs):
     url = "https://api.scryfall.com/cards/search?q="
     url += "+".join(quote_plus(f"{key}:{value}") for key, value in kwargs.items())
-    content = get_content(url)
+    if order:
+        url += f"&order={order}"
+    return url
+
+
+def search(**kwargs):
+    """General search using scryfall search engine"""
+    content = get_content(get_search_url(**kwargs))
     if not content.get("object", "error") == "error": 
         return content.get("data", content)
     else:
         return None
 
 
+def iter_search(order=None, **kwargs):
+    """Search page by page, next pages are only fetched when the iteration reaches them"""
+    url = get_search_url(order, **kwargs)
+    while url:
+        content = get_content(url, all_pages=False)
+        if not content or content.get("object", "error") == "error":
+            return
+        yield from content.get("data", [])
+        url = content.get("next_page") if content.get("has_more") else None
+
+
 def get_random_card(query=None):
     url = "https://api.scryfall.com/cards/random"
     if query:
@@ -1,94 +1,266 @@
 import config
 import scryfall
 import im_utils
+import metrics
+from io import BytesIO
+from time import perf_counter
+from functools import wraps, partial
+from threading import Thread, Event
+from concurrent.futures import ThreadPoolExecutor
 from yolo import Yolo
 from datetime import datetime, timedelta
-from time import sleep
-from reddit import Reddit
 from mythicspoiler import MythicSpoiler
-from model import Session, Spoiler, Image, SpoilerSource, Set, update_sets
-from spoiler_detector import SpoilerDetector
+from model import Session, Spoiler, Image, SpoilerSource, Set, update_sets, claim_items, finish_items, \
+    done_items, subscribe, unsubscribe, migrate
+from spoiler_detector import SpoilerDetector, DescriptorIndex, NameIndex, DecisionCache
+from cluster import Cluster
+from publisher import Publisher
+from subscribers import SubscriberIndex
+from profiler import SamplingProfiler
+from scheduler import CrawlScheduler
 from prawcore.requestor import RequestException
+from telegram import ParseMode
+
+
+def when_ready(command):
+    """Answer commands needing the database only once the controller is loaded"""
+    @wraps(command)
+    def wrapper(self, update, context):
+        if not self.ready.is_set():
+            update.message.reply_text("I'm starting, try again in a few seconds", quote=True)
+            return
+        return command(self, update, context)
+    return wrapper
+
+
+class SpoiledRecord:
+    """Spoiler kept in memory for the limit_days, its descriptors are in the DescriptorIndex under its id"""
+    __slots__ = ("id", "image_id", "found_at", "source", "set_code")
+
+    def __init__(self, id, image_id, found_at, source, set_code):
+        self.id = id
+        self.image_id = image_id
+        self.found_at = found_at
+        self.source = source
+        self.set_code = set_code
+
+    def __repr__(self):
+        return f"<SpoiledRecord(id={self.id}, found_at={self.found_at}, source={self.source})>"
 
 
 class SpoilerController:
 
-    def __init__(self, updater):
+    def __init__(self, updater, lazy=False):
+        """
+        :param lazy: return at once and load the database, spoiled images and models in a background thread,
+        crawl jobs start once loaded
+        """
+        self.updater = updater
         self.sd = SpoilerDetector()
         self.ms = MythicSpoiler()
+        self.yolo = None
+        self.reddit = None
+        self.cluster = Cluster(enabled=getattr(config, "cluster", False))
+        self.publisher = Publisher(updater.bot)
+        self.subscribers = SubscriberIndex(default_chats=[config.chat_id])
+        self.profiler = SamplingProfiler()
+        # Downloads of the images of a reddit gallery
+        self.downloads = ThreadPoolExecutor(max_workers=8, thread_name_prefix="Download")
+        # Telegram file_id of sent images by image id, unsaved ones are written to db at next crawl
+        self.file_ids = {}
+        self.unsaved_file_ids = {}
+        # Items claimed by this worker or already processed. The database decides which worker processes them,
+        # items held by another worker are looked at again, to be taken over once their claim is stale
+        self.scryfall_futur_cards_id = set()
+        self.reddit_futur_cards_subm_id = set()
+        self.mythicspoiler_futur_cards_url = set()
+        # Codes of announced sets which may have a mythicspoiler gallery, crawled for cards
+        self.futur_set_codes = []
+        self.mythicspoiler_nodes = None
+        self.limit_days = 45
+        # SpoiledRecord by spoiler id, spoilers found during the last limit_days
+        self.spoiled = {}
+        self.index = DescriptorIndex()
+        # Names of spoiled cards, a known name is a duplicate without looking at the image
+        self.names = NameIndex()
+        # Spoilers an image url or content was found to be, images seen again are not described again
+        self.decisions = DecisionCache()
+        # Crawl tasks, fast during preview season and when a source is active.
+        # Cluster jobs change the spoiled list and the leader state, they run between crawls and never during one
+        self.scheduler = CrawlScheduler()
+        if self.cluster.enabled:
+            self.scheduler.add("heartbeat", self.cluster.heartbeat, interval=30, urgent=True)
+        self.scheduler.add("season", self.check_season, interval=3600)
+        self.scheduler.add("maintenance", self.maintenance, interval=60)
+        # Source crawls, /profile samples the ticks running at least one of them
+        self.crawl_tasks = [
+            self.scheduler.add("scryfall", self.scryfall_cards_crawl, interval=60, min_interval=30, max_interval=600,
+                               idle_interval=1800),
+            self.scheduler.add("mythicspoiler", self.mythicspoiler_crawl, interval=60, min_interval=30,
+                               max_interval=600, idle_interval=1800),
+            self.scheduler.add("mythicspoiler sets", self.mythicspoiler_sets_crawl, interval=120, min_interval=60,
+                               max_interval=900, idle_interval=3600),
+            self.scheduler.add("reddit", self.reddit_crawl, interval=60, min_interval=20, max_interval=300,
+                               idle_interval=900)]
+        if self.cluster.enabled:
+            self.scheduler.add("pending", self.publish_pending, interval=15)
+        # Startup steps done, reported by /test
+        self.loaded = []
+        self.ready = Event()
+        if lazy:
+            Thread(target=self.load_in_background, name="Startup", daemon=True).start()
+        else:
+            self.load()
+
+    def load(self):
+        """Load the database, spoiled images and models, then start the crawl jobs"""
+        start = perf_counter()
+        migrate()
+        self.cluster.heartbeat()
+        self.subscribers.reload()
+        self.loaded.append("database")
+        self.load_spoiled(Spoiler.found_at > datetime.today() - timedelta(days=self.limit_days))
+        self.loaded.append(f"{len(self.spoiled)} spoiled images")
         self.yolo = Yolo(config.model, config.classes, config.conf)
+        self.loaded.append("yolo")
+        # praw is slow to import, only needed by the crawl
+        from reddit import Reddit
         self.reddit = Reddit(subreddit="magicTCG")
-        self.scryfall_futur_cards_id = []
-        self.reddit_futur_cards_subm_id = []
-        self.mythicspoiler_futur_cards_url = []
-        self.limit_days = 45
-        # List of Spoiler Objects
-        limit_date = datetime.today() - timedelta(days=self.limit_days)
-        self.spoiled = Session.query(Spoiler).filter(Spoiler.found_at > limit_date).all()
+        self.loaded.append("reddit")
+        self.ready.set()
+        config.bot_logger.info(f"Spoiler controller loaded in {perf_counter() - start:.1f}s")
         # Job queues:
-        updater.job_queue.run_repeating(self.general_crawl, interval=60, first=10)
+        self.updater.job_queue.run_repeating(self.general_crawl, interval=self.scheduler.tick, first=1)
+
+    def load_in_background(self):
+        try:
+            self.load()
+        except Exception:
+            self.loaded.append("failed, see logs")
+            config.bot_logger.exception("Spoiler controller failed to load")
+
+    def status(self):
+        if self.ready.is_set():
+            return f"Ready, {len(self.spoiled)} spoiled images"
+        return "Starting, loaded: " + (", ".join(self.loaded) or "nothing yet")
 
     def general_crawl(self, context):
+        """Run the due crawl tasks, skipped while the previous ones are still running"""
+        due = self.scheduler.due()
+        if not due:
+            return
+        if self.scheduler.lock.locked() or not any(task in self.crawl_tasks for task in due):
+            # Skipped tick, or only heartbeat, maintenance... not a crawl cycle for /profile
+            self.scheduler.run_due(context)
+            return
+        with self.profiler.cycle():
+            self.scheduler.run_due(context)
+
+    @metrics.timed("maintenance")
+    def maintenance(self, context):
         self.update_db(context)
+        self.save_file_ids()
+        # Subscriptions may have been changed by another node
+        self.subscribers.reload()
         self.flush_old_spoilers()
-        self.scryfall_cards_crawl(context)
-        self.mythicspoiler_crawl(context)
-        self.reddit_crawl(context)
-        # Run here the new job ?
+        if self.cluster.enabled:
+            self.sync_spoiled()
 
-    def scryfall_cards_crawl(self, context):
-        local_session = Session()
-        futur_cards = scryfall.get_futur_cards()
-        for futur_card in futur_cards:
-            if not futur_card.get("id") in self.scryfall_futur_cards_id:
-                config.bot_logger.info(f"New card detected from scryfall: {futur_card.get('name')}")
-                # New card detected, add it to scryfall list
-                self.scryfall_futur_cards_id.append(futur_card.get("id"))
-                # Try to see if it has already been spoiled
-                for i_url in scryfall.get_image_urls(futur_card):
-                    im = Image(location=i_url,
-                               descr=im_utils.descript_image(i_url))
-                    if not self.sd.is_duplicate(im, [s.image.descr for s in self.spoiled]):
-                        # card not recognize as a duplicate, save then publish it
-                        local_session.add(im)
-                        sp = Spoiler(url=scryfall.get_card_url(futur_card),
-                                     source=SpoilerSource.SCRYFALL.value,
-                                     source_id=futur_card.get("id"),
-                                     found_at=datetime.now(),
-                                     set_code=futur_card.get("set_code", None))
-                        sp.image = im
-                        local_session.add(sp)
-                        self.spoiled.append(sp)
-                        sp.set = local_session.query(Set).filter(Set.code == futur_card.get("set_code")).first()
-                        self.send_spoiler(sp, context)
-        local_session.commit()
+    def check_season(self, context):
+        """Crawl slowly when no futur set is announced"""
+        futur_sets = scryfall.get_futur_sets()
+        self.futur_set_codes = [s.get("code") for s in futur_sets
+                                if s.get("set_type") in MythicSpoiler.gallery_set_types]
+        self.scheduler.idle = not futur_sets
 
-    def mythicspoiler_crawl(self, context):
+    @metrics.timed("scryfall_crawl")
+    def scryfall_cards_crawl(self, context):
         local_session = Session()
-        cards = self.ms.get_cards_from_news()
-        for page, image_url, card_set in cards:
-            if image_url not in self.mythicspoiler_futur_cards_url:
-                config.bot_logger.info(f"New card detected from mythicspoiler: {page}")
-                # New card detected on mythic spoiler, save it
-                self.mythicspoiler_futur_cards_url.append(image_url)
-                # Try to see if it has already been spoiled
-                im = Image(location=image_url,
-                           descr=im_utils.descript_image(image_url))
-                if not self.sd.is_duplicate(im, [s.image.descr for s in self.spoiled]):
+        futur_cards = {c.get("id"): c for c in scryfall.get_futur_cards() or []
+                       if c.get("id") not in self.scryfall_futur_cards_id and self.cluster.owns(c.get("id"))}
+        claimed = claim_items(SpoilerSource.SCRYFALL, futur_cards)
+        self.mark_seen(self.scryfall_futur_cards_id, SpoilerSource.SCRYFALL, futur_cards, claimed)
+        for card_id in claimed:
+            futur_card = futur_cards[card_id]
+            config.bot_logger.info(f"New card detected from scryfall: {futur_card.get('name')}")
+            if self.is_known_name(futur_card.get("name")):
+                continue
+            # Try to see if it has already been spoiled
+            for i_url in scryfall.get_image_urls(futur_card):
+                im, keys = self.describe_new_image(i_url)
+                if im is not None:
                     # card not recognize as a duplicate, save then publish it
                     local_session.add(im)
-                    sp = Spoiler(url=page,
-                                 source=SpoilerSource.MYTHICSPOILER.value,
-                                 source_id=SpoilerSource.MYTHICSPOILER.value,
+                    sp = Spoiler(url=scryfall.get_card_url(futur_card),
+                                 source=SpoilerSource.SCRYFALL.value,
+                                 source_id=futur_card.get("id"),
+                                 name=futur_card.get("name"),
                                  found_at=datetime.now(),
-                                 set_code=card_set)
+                                 set_code=futur_card.get("set_code", None))
                     sp.image = im
-                    sp.set = local_session.query(Set).filter(Set.code == card_set).first()
                     local_session.add(sp)
-                    self.spoiled.append(sp)
-                    self.send_spoiler(sp, context)
+                    sp.set = local_session.query(Set).filter(Set.code == futur_card.get("set_code")).first()
+                    local_session.flush()
+                    self.add_spoiled(sp)
+                    self.decisions.put(keys, {sp.id})
+                    self.publish([sp])
+        local_session.commit()
+        finish_items(SpoilerSource.SCRYFALL, claimed)
+        return len(claimed)
+
+    @metrics.timed("mythicspoiler_crawl")
+    def mythicspoiler_crawl(self, context):
+        return self.mythicspoiler_cards_crawl(self.ms.get_cards_from_news(known=self.mythicspoiler_futur_cards_url))
+
+    @metrics.timed("mythicspoiler_sets_crawl")
+    def mythicspoiler_sets_crawl(self, context):
+        """Crawl galleries of futur sets, cards may be added there without being on the news page"""
+        if self.cluster.nodes != self.mythicspoiler_nodes:
+            # Cards owned by this node changed, unchanged pages may hold cards it never processed
+            self.ms.fingerprints.clear()
+            self.mythicspoiler_nodes = self.cluster.nodes
+        return self.mythicspoiler_cards_crawl(self.ms.get_cards_from_sets(self.futur_set_codes))
+
+    def mythicspoiler_cards_crawl(self, cards):
+        """
+        Process new cards found on mythicspoiler
+        :param cards: list of tuple (card_url, card_image_url, expansion)
+        :return: number of new cards
+        """
+        local_session = Session()
+        cards = {image_url: (page, card_set) for page, image_url, card_set in cards
+                 if image_url not in self.mythicspoiler_futur_cards_url and self.cluster.owns(image_url)}
+        claimed = claim_items(SpoilerSource.MYTHICSPOILER, cards)
+        self.mark_seen(self.mythicspoiler_futur_cards_url, SpoilerSource.MYTHICSPOILER, cards, claimed)
+        for image_url in claimed:
+            page, card_set = cards[image_url]
+            config.bot_logger.info(f"New card detected from mythicspoiler: {page}")
+            name = self.ms.get_card_name(page)
+            if self.is_known_name(name):
+                continue
+            # Try to see if it has already been spoiled
+            im, keys = self.describe_new_image(image_url)
+            if im is not None:
+                # card not recognize as a duplicate, save then publish it
+                local_session.add(im)
+                sp = Spoiler(url=page,
+                             source=SpoilerSource.MYTHICSPOILER.value,
+                             source_id=SpoilerSource.MYTHICSPOILER.value,
+                             name=name,
+                             found_at=datetime.now(),
+                             set_code=card_set)
+                sp.image = im
+                sp.set = local_session.query(Set).filter(Set.code == card_set).first()
+                local_session.add(sp)
+                local_session.flush()
+                self.add_spoiled(sp)
+                self.decisions.put(keys, {sp.id})
+                self.publish([sp])
         local_session.commit()
+        finish_items(SpoilerSource.MYTHICSPOILER, claimed)
+        return len(claimed)
 
+    @metrics.timed("reddit_crawl")
     def reddit_crawl(self, context):
         local_session = Session()
         try:
@@ -96,30 +268,44 @@ class SpoilerController:
         except RequestException as e:
             config.bot_logger.error(e)
             submissions = []
-        for submission in submissions:
-            if submission in self.reddit_futur_cards_subm_id or not self.sd.is_reddit_spoiler(submission):
-                continue
-            self.reddit_futur_cards_subm_id.append(submission)
+        submissions = {sub.id: sub for sub in submissions
+                       if sub.id not in self.reddit_futur_cards_subm_id and self.cluster.owns(sub.id)
+                       and self.sd.is_reddit_spoiler(sub)}
+        claimed = claim_items(SpoilerSource.REDDIT, submissions)
+        self.mark_seen(self.reddit_futur_cards_subm_id, SpoilerSource.REDDIT, submissions, claimed)
+        for submission_id in claimed:
+            submission = submissions[submission_id]
             link = "https://www.reddit.com" + submission.permalink
             config.bot_logger.info(f"New card spoiler submission from reddit: {link}")
             # Got a spoiler
-            images = []
-            # Crawl images from submission
-            if hasattr(submission, "is_gallery"):
-                for key, value in submission.media_metadata.items():
-                    images.append(value.get("s", {}).get("u"))
-            elif hasattr(submission, "preview"):
-                images.append(submission.preview.get("images", [])[0].get("source").get("url"))
+            # Crawl images from submission, a preview resolution is enough to detect cards
+            pixel_budget = getattr(config, "reddit_pixel_budget", 700000)
+            images = [urls for urls in self.reddit.get_images(submission, pixel_budget)
+                      if self.decisions.get(urls[0]) is None]
+            pictures = self.downloads.map(lambda urls: im_utils.imread_url(urls[0], flags=1), images)
 
             # Use YOLOv4 model to detect if image is composed of multiple cards
             subspoilers_images = []
-            for image_url in images:
-                subspoilers = self.yolo.get_detected_objects(image_url)
-                for image, confidence in subspoilers:
-                    i = Image(location=image_url,
-                              descr=im_utils.descript_image(image))
+            # Url and content hash of the processed images, with the spoilers their cards are
+            keys, spoiler_ids = [], set()
+            for (image_url, source_url), picture in zip(images, pictures):
+                if picture is None:
+                    continue
+                digest = im_utils.content_hash(picture)
+                known = self.decisions.get(digest)
+                if known is not None:
+                    self.decisions.put([image_url], known)
+                    continue
+                keys += [image_url, digest]
+                subspoilers = self.yolo.get_detected_objects(picture)
+                for image, confidence, box in subspoilers:
+                    descr, phash = im_utils.describe_image(image)
+                    i = Image(location=source_url, descr=descr, phash=phash,
+                              descr_version=im_utils.descriptor_version)
+                    # The card sent is cropped from the source resolution
+                    i.box = ",".join(f"{c:.6f}" for c in box)
                     i.cv_array = image
-                    local_session.add(i)
+                    i.detection_conf = confidence
                     subspoilers_images.append(i)
             config.bot_logger.info(f"Yolo found {len(subspoilers_images)} cards on {len(images)} images.")
             # Remove potentiel duplicate within the submission itself
@@ -131,7 +317,8 @@ class SpoilerController:
             # For each image, test if descriptor is in spoiled card, if not create spoiler
             sub_spoiler = []
             for image in subspoilers_images:
-                if not self.sd.is_duplicate(image, [s.image.descr for s in self.spoiled]):
+                duplicate_of = self.sd.find_duplicate(image, self.index)
+                if duplicate_of is None:
                     sp = Spoiler(url=link,
                                  source=SpoilerSource.REDDIT.value,
                                  source_id=submission.id,
@@ -140,19 +327,169 @@ class SpoilerController:
                     if s:
                         sp.set = s
                     local_session.add(sp)
-                    self.spoiled.append(sp)
+                    local_session.flush()
+                    self.add_spoiled(sp)
                     sub_spoiler.append(sp)
+                    spoiler_ids.add(sp.id)
                 else:
                     config.bot_logger.info("Filtration found a duplicate in DB.")
-            # Create a message with reddit submission link then send images only
+                    spoiler_ids.add(duplicate_of)
+            self.decisions.put(keys, spoiler_ids)
+            # Send all cards of the submission as one album
             if len(sub_spoiler):
-                for spoil in sub_spoiler:
-                    self.send_spoiler(spoil, context)
+                self.publish(sub_spoiler)
             local_session.commit()
+            finish_items(SpoilerSource.REDDIT, [submission_id])
+        return len(claimed)
 
     @staticmethod
-    def send_spoiler(spoiler: Spoiler, context):
-        config.bot_logger.info(f"Send spoiler {spoiler} to channel.")
+    def mark_seen(seen, source, keys, claimed):
+        """Add to seen the keys claimed by this worker and those already done, not those held by another worker"""
+        seen.update(claimed)
+        if len(claimed) < len(keys):
+            seen.update(done_items(source, set(keys) - set(claimed)))
+
+    def publish(self, spoilers):
+        """Send spoilers if this node is the leader, otherwise leave them to the leader"""
+        metrics.spoilers_total.inc(len(spoilers), source=spoilers[0].source)
+        if self.cluster.is_leader():
+            self.send_spoilers(spoilers)
+        else:
+            for spoiler in spoilers:
+                spoiler.pending = True
+
+    def publish_pending(self, context):
+        """
+        Leader only: send spoilers found by other nodes. A pending spoiler is checked against every spoiler already
+        decided, sent by the leader or by a previous run, whatever its id: a card found by two nodes at the same
+        time is sent once. Crops are cropped again from their source image, cards of a reddit submission are sent
+        as one album.
+        """
+        if not self.cluster.is_leader():
+            return
+        local_session = Session()
+        pending = local_session.query(Spoiler).filter(Spoiler.pending == True).order_by(Spoiler.id).all()
+        # Synced after the query, every pending spoiler is in the index
+        self.sync_spoiled()
+        undecided = {spoiler.id for spoiler in pending}
+        albums = {}
+        for spoiler in pending:
+            album_id = spoiler.source_id if spoiler.source == SpoilerSource.REDDIT.value else spoiler.id
+            albums.setdefault((spoiler.source, album_id), []).append(spoiler)
+        for spoilers in albums.values():
+            new_spoilers = []
+            for spoiler in spoilers:
+                spoiler.pending = False
+                if self.sd.is_duplicate(spoiler.image, self.index, exclude=undecided):
+                    config.bot_logger.info(f"{spoiler} also found by another node, not sent.")
+                else:
+                    new_spoilers.append(spoiler)
+                undecided.discard(spoiler.id)
+            if new_spoilers:
+                self.send_spoilers(new_spoilers)
+        local_session.commit()
+
+    def sync_spoiled(self):
+        """Add spoilers found by other nodes to the spoiled list"""
+        limit_date = datetime.today() - timedelta(days=self.limit_days)
+        ids = {s.id for s in Session.query(Spoiler.id).filter(Spoiler.found_at > limit_date)} - self.spoiled.keys()
+        if ids:
+            self.load_spoiled(Spoiler.id.in_(ids))
+
+    def load_spoiled(self, *criteria):
+        """Add spoilers matching criteria to the spoiled list, only the needed columns are read, no ORM objects"""
+        query = Session.query(Spoiler.id, Spoiler.image_id, Spoiler.found_at, Spoiler.source, Spoiler.set_code,
+                              Spoiler.name, Image.descr, Image.phash).join(Image, Spoiler.image_id == Image.id)
+        for row in query.filter(*criteria).yield_per(1000):
+            self.spoiled[row.id] = SpoiledRecord(row.id, row.image_id, row.found_at, row.source, row.set_code)
+            self.index.add(row.id, row.descr, row.phash)
+            self.names.add(row.id, row.name)
+
+    def add_spoiled(self, spoiler: Spoiler):
+        """Keep spoiler in memory and index its descriptors, spoiler must have an id (flushed)"""
+        self.spoiled[spoiler.id] = SpoiledRecord(spoiler.id, spoiler.image.id, spoiler.found_at, spoiler.source,
+                                                 spoiler.set_code)
+        self.index.add(spoiler.id, spoiler.image.descr, spoiler.image.phash)
+        self.names.add(spoiler.id, spoiler.name)
+
+    def describe_new_image(self, url):
+        """
+        Download and describe an image, unless it is a duplicate of a spoiled image.
+        An image seen before, by url or by content, gets the previous decision without being described again.
+        :return: tuple (new Image, decision cache keys of the image), Image is None if it is a duplicate
+        """
+        if self.decisions.get(url) is not None:
+            return None, []
+        picture = im_utils.imread_url(url)
+        if picture is None:
+            return None, []
+        digest = im_utils.content_hash(picture)
+        known = self.decisions.get(digest)
+        if known is not None:
+            self.decisions.put([url], known)
+            return None, []
+        descr, phash = im_utils.describe_image(picture, url)
+        im = Image(location=url, descr=descr, phash=phash, descr_version=im_utils.descriptor_version)
+        duplicate_of = self.sd.find_duplicate(im, self.index)
+        if duplicate_of is not None:
+            self.decisions.put([url, digest], {duplicate_of})
+            return None, []
+        return im, [url, digest]
+
+    def is_known_name(self, name):
+        """True if a card of this name was spoiled, then its image doesn't need to be compared"""
+        spoiler_id = self.names.lookup(name)
+        if spoiler_id is None:
+            return False
+        config.bot_logger.info(f"{name} considered as duplicate of spoiler {spoiler_id} by its name.")
+        metrics.dedup_checks_total.inc()
+        metrics.dedup_hits_total.inc()
+        return True
+
+    def send_spoilers(self, spoilers):
+        """
+        Queue spoilers to the channel and subscribed chats, several spoilers are sent as one album
+        :param spoilers: list of Spoiler objects with the same set and source
+        """
+        chats = self.subscribers.get_chats(spoilers[0].set_code, spoilers[0].source)
+        # Upload to the main channel first, the other chats get the telegram file_id
+        chats = sorted(chats, key=lambda chat_id: chat_id != config.chat_id)
+        config.bot_logger.info(f"Send spoilers {spoilers} to {len(chats)} chats.")
+        sources = {}
+        self.publisher.publish(chats,
+                               [self.get_photo(spoiler, sources) for spoiler in spoilers],
+                               keys=[spoiler.image.id for spoiler in spoilers],
+                               on_sent=self.store_file_ids)
+        # Photos are encoded or held by the publisher, crops are not needed anymore
+        for spoiler in spoilers:
+            spoiler.image.cv_array = None
+
+    def store_file_ids(self, image_ids, file_ids):
+        """Called by the publisher once photos are uploaded"""
+        for image_id, file_id in zip(image_ids, file_ids):
+            if image_id and file_id:
+                self.file_ids[image_id] = file_id
+                self.unsaved_file_ids[image_id] = file_id
+
+    def save_file_ids(self):
+        """Write telegram file_ids of the last uploaded images to db"""
+        if not self.unsaved_file_ids:
+            return
+        mappings = []
+        while self.unsaved_file_ids:
+            image_id, file_id = self.unsaved_file_ids.popitem()
+            mappings.append({"id": image_id, "file_id": file_id})
+        local_session = Session()
+        local_session.bulk_update_mappings(Image, mappings)
+        local_session.commit()
+
+    def get_photo(self, spoiler: Spoiler, sources=None):
+        """
+        Build telegram photo for a spoiler, an image already uploaded is sent again with its file_id
+        :param sources: source images by url, cards of an album are cropped from the same downloaded image
+        :return: tuple (photo, caption), photo of a card found on a bigger image is a function cropping it,
+        called by the publisher
+        """
         set_text = ""
         if spoiler.set:  # https://scryfall.com/sets/aer
             if spoiler.source == SpoilerSource.MYTHICSPOILER.value:
@@ -162,26 +499,103 @@ class SpoilerController:
             set_text += f"from <a href='{set_url}'>{spoiler.set.name}</a> "
         caption = f"New spoiler {set_text}!\nSource: <a href='{spoiler.url}'>{spoiler.source}</a>\n"\
                   f"<i>confidence = {spoiler.image.conf}%</i>"
-        if spoiler.image.cv_array is not None:
+        file_id = spoiler.image.file_id or self.file_ids.get(spoiler.image.id)
+        if file_id:
+            return file_id, caption
+        crop = spoiler.image.cv_array
+        if spoiler.image.box:
+            sources = {} if sources is None else sources
+            return partial(self.crop_source, spoiler.image.location, spoiler.image.box, sources, crop), caption
+        if crop is not None:
             # Send photo directly if image is open_cv array
-            context.bot.send_photo(chat_id=config.chat_id,
-                                   photo=im_utils.get_file_from_cv_image(spoiler.image.cv_array),
-                                   caption=caption,
-                                   parse_mode="HTML")
+            return im_utils.get_file_from_cv_image(crop, getattr(config, "jpeg_quality", 90)), caption
+        # Send url in message text
+        return spoiler.image.location, caption
+
+    @staticmethod
+    def crop_source(location, box, sources, fallback=None):
+        """
+        Photo of a card cropped from its source image at full resolution, run by the publisher thread
+        :param box: "x1,y1,x2,y2" relative box of the card
+        :param sources: source images by url, downloaded once for all cards of an album
+        :param fallback: card crop sent if the source can't be downloaded
+        """
+        if location not in sources:
+            sources[location] = im_utils.imread_url(location, flags=1)
+        crop = fallback
+        if sources[location] is not None:
+            crop = im_utils.crop_relative(sources[location], [float(c) for c in box.split(",")])
+        if crop is None:
+            return location
+        return im_utils.get_file_from_cv_image(crop, getattr(config, "jpeg_quality", 90))
+
+    @when_ready
+    def subscribe(self, update, context):
+        """
+        /subscribe command: receive all spoilers in this chat, or only those of the given sets and sources
+        Example: /subscribe khm reddit
+        """
+        chat_id = update.effective_chat.id
+        sources = {s.name.lower(): s.value for s in SpoilerSource}
+        sets, spoiler_sources = [], []
+        for arg in context.args:
+            arg = arg.lower()
+            if arg in sources:
+                spoiler_sources.append(sources[arg])
+            elif Session.query(Set).filter(Set.code == arg).first():
+                sets.append(arg)
+            else:
+                update.message.reply_text(f"Unknown set or source: {arg}", quote=True)
+                return
+        for set_code in sets or [None]:
+            for source in spoiler_sources or [None]:
+                subscribe(chat_id, set_code=set_code, source=source)
+        self.subscribers.reload()
+        update.message.reply_text("Subscribed to " + (" ".join(context.args) or "all spoilers"), quote=True)
+
+    @when_ready
+    def unsubscribe(self, update, context):
+        """/unsubscribe command: stop receiving spoilers in this chat"""
+        count = unsubscribe(update.effective_chat.id)
+        self.subscribers.reload()
+        update.message.reply_text(f"Removed {count} subscription(s)", quote=True)
+
+    def profile(self, update, context):
+        """Command /profile [cycles], sample the next crawl cycles and send back the profile"""
+        try:
+            cycles = int(context.args[0]) if context.args else 1
+        except ValueError:
+            update.message.reply_text("Usage: /profile [number of crawl cycles]", quote=True)
+            return
+        chat_id = update.effective_chat.id
+
+        def send_profile(profiler):
+            document = BytesIO(profiler.collapsed().encode())
+            document.name = "crawl.collapsed"
+            context.bot.send_document(chat_id, document=document,
+                                      caption="Collapsed stacks, open with speedscope or flamegraph.pl")
+            context.bot.send_message(chat_id, profiler.summary(), parse_mode=ParseMode.HTML)
+
+        if self.profiler.start(max(cycles, 1), on_done=send_profile):
+            update.message.reply_text(f"Profiling the next {max(cycles, 1)} crawl cycle(s)", quote=True)
         else:
-            # Send url in message text
-            context.bot.send_photo(chat_id=config.chat_id,
-                                   photo=spoiler.image.location,
-                                   caption=caption,
-                                   parse_mode="HTML")
-        # Avoid spam
-        sleep(0.1)
+            update.message.reply_text("A profile is already running", quote=True)
+
+    def schedule(self, update, context):
+        """Command /schedule, show crawl intervals and next runs"""
+        update.message.reply_text(self.scheduler.describe(), quote=True, parse_mode=ParseMode.HTML)
 
     @staticmethod
     def update_db(context):
         update_sets()
 
     def flush_old_spoilers(self):
-        for spoiler in self.spoiled:
-            if spoiler.found_at < datetime.today() - timedelta(days=self.limit_days):
-                self.spoiled.remove(spoiler)
+        limit_date = datetime.today() - timedelta(days=self.limit_days)
+        old = [record for record in self.spoiled.values() if record.found_at < limit_date]
+        for record in old:
+            del self.spoiled[record.id]
+            self.file_ids.pop(record.image_id, None)
+        if old:
+            self.index.remove([record.id for record in old])
+            self.names.remove([record.id for record in old])
+            self.decisions.invalidate([record.id for record in old])
@@ -1,6 +1,240 @@
 import re
+import unicodedata
+from time import monotonic
+from collections import defaultdict, OrderedDict
+import numpy as np
 import im_utils
 import config
+import metrics
+
+
+class DescriptorIndex:
+    """
+    Descriptors of spoiled images stored as arrays for vectorized matching:
+    int64 array of 64 bits phashes for a cheap first stage and matrix of sqrt histograms for confirmation.
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.hashes = []
+        self.hists = []
+        self._arrays = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, descr, phash=None):
+        """
+        :param key: id of the spoiler
+        :param descr: histogram as array or raw bytes from db
+        :param phash: signed 64 bits phash, None for images described before phash existed
+        """
+        if not isinstance(descr, np.ndarray):
+            descr = np.frombuffer(descr, dtype=np.float32)
+        self.keys.append(key)
+        self.hashes.append(phash)
+        self.hists.append(im_utils.sqrt_histograms(descr)[0])
+        self._arrays = None
+
+    def remove(self, keys):
+        keys = set(keys)
+        kept = [i for i, k in enumerate(self.keys) if k not in keys]
+        self.keys = [self.keys[i] for i in kept]
+        self.hashes = [self.hashes[i] for i in kept]
+        self.hists = [self.hists[i] for i in kept]
+        self._arrays = None
+
+    def arrays(self):
+        """Arrays rebuilt only after a change: keys, hashes, hash missing mask, sqrt histograms"""
+        if self._arrays is None:
+            hashes = np.array([h if h is not None else 0 for h in self.hashes], dtype=np.int64)
+            no_hash = np.array([h is None for h in self.hashes], dtype=bool)
+            hists = np.vstack(self.hists) if self.hists else np.empty((0, 0), dtype=np.float32)
+            # Rows become views of the matrix, histograms are not held twice
+            self.hists = list(hists)
+            self._arrays = np.array(self.keys), hashes, no_hash, hists
+        return self._arrays
+
+    @metrics.timed("descriptor_match")
+    def query(self, descr, phash=None, max_hamming=64, exclude=None, k=1):
+        """
+        Two stages search: phash near matches, then histogram distances of those candidates only
+        :param descr: histogram of the searched image
+        :param phash: phash of the searched image, None to compare every histogram
+        :param max_hamming: maximal phash distance of candidates
+        :param exclude: keys not to consider
+        :param k: number of closest keys returned
+        :return: list of at most k tuple (distance x 100, key) sorted by distance
+        """
+        if not self.keys:
+            return []
+        keys, hashes, no_hash, hists = self.arrays()
+        candidates = np.ones(len(keys), dtype=bool)
+        if phash is not None:
+            candidates = no_hash | (im_utils.hamming_distances(phash, hashes) <= max_hamming)
+        if exclude:
+            candidates &= ~np.isin(keys, list(exclude))
+        count = np.count_nonzero(candidates)
+        if not count:
+            return []
+        if count > len(keys) // 2:
+            # Most stored images are candidates, comparing to the whole matrix is cheaper than copying their rows
+            indexes = np.arange(len(keys))
+            distances = im_utils.bhattacharyya_distances(descr, hists) * 100
+            distances[~candidates] = np.inf
+        else:
+            indexes = np.flatnonzero(candidates)
+            distances = im_utils.bhattacharyya_distances(descr, hists[indexes]) * 100
+        k = min(k, count)
+        if k == 1:
+            order = [np.argmin(distances)]
+        else:
+            # Only the k closest are sorted
+            order = np.argpartition(distances, k - 1)[:k]
+            order = order[np.argsort(distances[order])]
+        return [(float(distances[i]), keys[indexes[i]].item()) for i in order]
+
+
+class DecisionCache:
+    """
+    Previous duplicate decisions by image url and content hash, so an image seen again is not described again.
+    A decision is the set of spoiler ids the image was found to be (new spoiler or duplicate), valid while all of
+    them are spoiled. Images found new are spoiled at once, so only duplicate decisions need to be stored.
+    """
+
+    def __init__(self, ttl=6 * 3600, max_size=20000):
+        """
+        :param ttl: seconds a decision is kept
+        :param max_size: number of keys kept, least recently used are dropped first
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()  # key -> (spoiler ids, expiration)
+        self.keys_by_spoiler = defaultdict(set)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, *keys):
+        """
+        :return: frozenset of spoiler ids of the first known key, None if no key is known
+        """
+        now = monotonic()
+        for key in keys:
+            entry = self.entries.get(key)
+            if entry is None:
+                continue
+            if entry[1] < now:
+                self.drop(key)
+                continue
+            self.entries.move_to_end(key)
+            metrics.dedup_cache_hits_total.inc()
+            return entry[0]
+        return None
+
+    def put(self, keys, spoiler_ids):
+        spoiler_ids = frozenset(spoiler_ids)
+        expiration = monotonic() + self.ttl
+        for key in keys:
+            self.drop(key)
+            self.entries[key] = (spoiler_ids, expiration)
+            for spoiler_id in spoiler_ids:
+                self.keys_by_spoiler[spoiler_id].add(key)
+        while len(self.entries) > self.max_size:
+            self.drop(next(iter(self.entries)))
+
+    def drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for spoiler_id in entry[0]:
+            self.keys_by_spoiler[spoiler_id].discard(key)
+            if not self.keys_by_spoiler[spoiler_id]:
+                del self.keys_by_spoiler[spoiler_id]
+
+    def invalidate(self, spoiler_ids):
+        """Forget decisions involving these spoilers, when they leave the index"""
+        for spoiler_id in spoiler_ids:
+            for key in list(self.keys_by_spoiler.get(spoiler_id, ())):
+                self.drop(key)
+
+
+def normalize_name(name):
+    """Lower case letters and digits only, accents removed: "Lim-Dûl's Vault" -> "limdulsvault" """
+    name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode()
+    return re.sub(r"[^a-z0-9]", "", name.lower())
+
+
+def trigrams(key):
+    return {key[i:i + 3] for i in range(len(key) - 2)}
+
+
+class NameIndex:
+    """
+    Card names of spoiled cards: exact lookup of normalized names, then fuzzy lookup through a trigram index
+    for spelling variations between sources. Double faced cards are also indexed by face.
+    """
+
+    def __init__(self, min_similarity=0.85):
+        """
+        :param min_similarity: minimal Jaccard similarity of trigrams for a fuzzy match
+        """
+        self.min_similarity = min_similarity
+        self.keys = defaultdict(set)  # normalized name -> spoiler ids
+        self.grams = defaultdict(set)  # trigram -> normalized names
+        self.names = {}  # spoiler id -> normalized names
+
+    def __len__(self):
+        return len(self.names)
+
+    @staticmethod
+    def get_keys(name):
+        faces = [name] + (name.split("//") if "//" in name else [])
+        return {key for key in map(normalize_name, faces) if key}
+
+    def add(self, key, name):
+        """
+        :param key: id of the spoiler
+        :param name: card name, ignored if None
+        """
+        if not name:
+            return
+        self.names[key] = self.get_keys(name)
+        for name_key in self.names[key]:
+            self.keys[name_key].add(key)
+            for gram in trigrams(name_key):
+                self.grams[gram].add(name_key)
+
+    def remove(self, keys):
+        for key in keys:
+            for name_key in self.names.pop(key, ()):
+                self.keys[name_key].discard(key)
+                if self.keys[name_key]:
+                    continue
+                del self.keys[name_key]
+                for gram in trigrams(name_key):
+                    self.grams[gram].discard(name_key)
+                    if not self.grams[gram]:
+                        del self.grams[gram]
+
+    def lookup(self, name):
+        """
+        :return: id of a spoiler of this card, None if the name is unknown
+        """
+        for name_key in self.get_keys(name or ""):
+            if name_key in self.keys:
+                return next(iter(self.keys[name_key]))
+            grams = trigrams(name_key)
+            if not grams:
+                continue
+            shared = defaultdict(int)
+            for gram in grams:
+                for candidate in self.grams.get(gram, ()):
+                    shared[candidate] += 1
+            for candidate, count in shared.items():
+                if count / len(grams | trigrams(candidate)) >= self.min_similarity:
+                    return next(iter(self.keys[candidate]))
+        return None
 
 
 class SpoilerDetector:
@@ -9,6 +243,11 @@ class SpoilerDetector:
     """
 
     distance_conf = 30
+    # Compare histograms of phash near matches only. A hard gate: a card whose phash is further than phash_distance
+    # bits (out of 64) is never compared by histograms. Off until the two stages table of benchmarks.dedup shows
+    # its recall on real cards, every histogram is compared meanwhile
+    phash_gate = False
+    phash_distance = 24
     reddit_set_reg = r"^\[(.{3,4})\]"
     flairs = ["Spoiler", "News"]
     domain = "self.magicTCG"
@@ -36,34 +275,70 @@ class SpoilerDetector:
     @staticmethod
     def remove_duplicates(images, confidence):
         """
-        Compare image hashes between them to remove potential duplicates
+        Cluster near-duplicate images of a batch (pairwise distance matrix + union-find)
+        and keep the best image of each cluster: highest detection confidence, then highest resolution
         :param images: list of Image model object
-        :param confidence: minimum distance between hashes to remove duplicates
-        :return: initial list minus duplicates
-        """
-        copy_images = images
-        for n, image in enumerate(images):
-            descriptors = [i.descr for i in copy_images]
-            for d, h in im_utils.get_closest_match(image, descriptors):
-                if d < confidence and not d == 0:
-                    del copy_images[n]
-                    break
-        return copy_images
+        :param confidence: maximal distance between descriptors of duplicates
+        :return: one image per cluster, in the initial order
+        """
+        if len(images) < 2:
+            return list(images)
+        descriptors = [i.descr if isinstance(i.descr, np.ndarray) else np.frombuffer(i.descr, dtype=np.float32)
+                       for i in images]
+        sqrt_hists = im_utils.sqrt_histograms(np.vstack(descriptors))
+        distances = np.sqrt(np.clip(1 - sqrt_hists @ sqrt_hists.T, 0, None)) * 100
+        parents = list(range(len(images)))
 
-    @staticmethod
-    def is_duplicate(image, descriptors, confidence=29):
+        def find(i):
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+
+        for i, j in zip(*np.nonzero(np.triu(distances < confidence, k=1))):
+            parents[find(i)] = find(j)
+        clusters = {}
+        for i in range(len(images)):
+            clusters.setdefault(find(i), []).append(i)
+
+        def quality(i):
+            image = images[i]
+            size = image.cv_array.shape[0] * image.cv_array.shape[1] if image.cv_array is not None else 0
+            return image.detection_conf or 0, size
+
+        return [images[i] for i in sorted(max(cluster, key=quality) for cluster in clusters.values())]
+
+    @classmethod
+    def is_duplicate(cls, image, index: DescriptorIndex, confidence=29, exclude=None):
         """
-        Test if phash has a near-duplicate hash in list
-        :param phash: phash to compare
-        :param phashes: list of phash
+        Test if image has a near-duplicate in the index, image.conf is set to the closest distance
+        :param image: Image model object
+        :param index: DescriptorIndex of spoiled images
         :param confidence: minimal distance to be a duplicate
-        :return: True if hash has a duplicate False if not
+        :param exclude: ids of spoilers not to compare to
+        :return: True if image has a duplicate False if not
+        """
+        return cls.find_duplicate(image, index, confidence, exclude) is not None
+
+    @classmethod
+    def find_duplicate(cls, image, index: DescriptorIndex, confidence=29, exclude=None):
+        """
+        Same as is_duplicate
+        :return: id of the closest spoiler if image is a duplicate, None if not
         """
-        for d, h in im_utils.get_closest_match(image, descriptors, limit=10):
-            if d < confidence:
-                config.bot_logger.info(f"{image} considered as duplicate.")
-                return True
-        return False
+        descr = image.descr
+        if not isinstance(descr, np.ndarray):
+            descr = np.frombuffer(descr, dtype=np.float32)
+        phash = image.phash if cls.phash_gate else None
+        matches = index.query(descr, phash, max_hamming=cls.phash_distance, exclude=exclude)
+        metrics.dedup_checks_total.inc()
+        # No candidate means nothing looks alike
+        image.conf = int(matches[0][0]) if matches else 100
+        if matches and matches[0][0] < confidence:
+            config.bot_logger.info(f"{image} considered as duplicate of spoiler {matches[0][1]}.")
+            metrics.dedup_hits_total.inc()
+            return matches[0][1]
+        return None
 
     def detect_set(self, text: str):
         """
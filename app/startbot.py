@@ -2,9 +2,10 @@ import config
 import sys
 import traceback
 from telegram import ParseMode
-from telegram.ext import Updater, CommandHandler
+from telegram.ext import Updater, CommandHandler, Filters
 from telegram.utils.helpers import mention_html
 from spoiler_controller import SpoilerController
+import metrics
 
 
 def main():
@@ -16,10 +17,28 @@ def main():
 
     # Add test handler to see if bot still up
     updater.dispatcher.add_handler(CommandHandler("test", test))
+    # Admin only commands
+    admin = Filters.chat(chat_id=config.admin_id)
+    updater.dispatcher.add_handler(CommandHandler("stats", stats, filters=admin))
+    # Settings missing from a config.py written for a previous version keep their previous behaviour
+    metrics_port = getattr(config, "metrics_port", None)
+    if metrics_port:
+        metrics.start_server(metrics_port)
+
+    # Database, spoiled images and yolo model are loaded in background, commands are answered meanwhile
+    controller = SpoilerController(updater=updater, lazy=True)
+    updater.dispatcher.bot_data["controller"] = controller
+    updater.dispatcher.add_handler(CommandHandler("subscribe", controller.subscribe))
+    updater.dispatcher.add_handler(CommandHandler("unsubscribe", controller.unsubscribe))
+    updater.dispatcher.add_handler(CommandHandler("profile", controller.profile, filters=admin))
+    updater.dispatcher.add_handler(CommandHandler("schedule", controller.schedule, filters=admin))
 
     # Start the Bot
-    updater.start_polling()
-    SpoilerController(updater=updater)
+    if getattr(config, "answer_commands", True):
+        updater.start_polling()
+    else:
+        # Other node of a cluster, only run crawl jobs
+        updater.job_queue.start()
     config.bot_logger.info("Spoiler Bot Started")
     updater.bot.send_message(chat_id=config.admin_id,
                              text="Bot started")
@@ -74,8 +93,15 @@ def error(update, context):
 
 def test(update, context):
     text = "I'm still up"
+    controller = context.bot_data.get("controller")
+    if controller:
+        text += f"\n{controller.status()}"
     update.message.reply_text(text, quote=True)
 
 
+def stats(update, context):
+    update.message.reply_text(metrics.summary(), quote=True, parse_mode=ParseMode.HTML)
+
+
 if __name__ == '__main__':
     main()
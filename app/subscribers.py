@@ -0,0 +1,54 @@
+from collections import defaultdict
+from model import Session, Subscription
+
+
+class SubscriberIndex:
+    """
+    Precomputed index of subscribed chats by set and source,
+    so finding the chats of a spoiler costs a few dict lookups whatever the number of subscribers.
+    """
+
+    def __init__(self, default_chats=()):
+        """
+        :param default_chats: chats receiving every spoiler, like the main channel
+        """
+        self.default_chats = set(default_chats)
+        self.everything = set(self.default_chats)
+        self.by_set = defaultdict(set)
+        self.by_source = defaultdict(set)
+        self.by_set_source = defaultdict(set)
+
+    def reload(self):
+        """Rebuild the index from the subscription table"""
+        everything = set(self.default_chats)
+        by_set = defaultdict(set)
+        by_source = defaultdict(set)
+        by_set_source = defaultdict(set)
+        for sub in Session.query(Subscription):
+            if sub.set_code and sub.source:
+                by_set_source[(sub.set_code, sub.source)].add(sub.chat_id)
+            elif sub.set_code:
+                by_set[sub.set_code].add(sub.chat_id)
+            elif sub.source:
+                by_source[sub.source].add(sub.chat_id)
+            else:
+                everything.add(sub.chat_id)
+        # Replace whole containers, the publisher may read the index meanwhile
+        self.everything = everything
+        self.by_set = by_set
+        self.by_source = by_source
+        self.by_set_source = by_set_source
+
+    def get_chats(self, set_code, source):
+        """
+        Return chats subscribed to a spoiler
+        :param set_code: set code of the spoiler, can be None
+        :param source: SpoilerSource value of the spoiler
+        :return: set of chat ids
+        """
+        return self.everything | self.by_set.get(set_code, set()) | self.by_source.get(source, set()) \
+            | self.by_set_source.get((set_code, source), set())
+
+    def __len__(self):
+        return len(set().union(self.everything, *self.by_set.values(), *self.by_source.values(),
+                               *self.by_set_source.values()))
@@ -0,0 +1,32 @@
+import os
+import sys
+import tempfile
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config  # noqa: E402
+
+# Never touch the bot database, must be set before model is imported
+config.db = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'tests.db')}"
+
+import model  # noqa: E402
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    """Empty SQLite database of the test, used by model functions and sessions"""
+    db_engine = model.create_db_engine(f"sqlite:///{tmp_path / 'spoilersBot.db'}")
+    monkeypatch.setattr(model, "engine", db_engine)
+    model.session_factory.configure(bind=db_engine)
+    model.Session.remove()
+    yield db_engine
+    model.Session.remove()
+    db_engine.dispose()
+
+
+@pytest.fixture
+def db(engine):
+    """Database with the current schema"""
+    model.migrate()
+    return engine
@@ -0,0 +1,109 @@
+import threading
+from datetime import timedelta
+import pytest
+from sqlalchemy import inspect
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex, CreateTable
+from sqlalchemy.exc import IntegrityError
+import model
+from model import CrawlItem, CrawlStatus, SpoilerSource, claim_items, finish_items
+
+# Schema of a database created before migrate existed
+baseline_schema = [
+    "CREATE TABLE 'set' (code VARCHAR NOT NULL, name VARCHAR, released_at DATETIME, card_count INTEGER, "
+    "scryfall_id VARCHAR, PRIMARY KEY (code))",
+    "CREATE TABLE image (id INTEGER NOT NULL, location VARCHAR, descr BLOB, conf INTEGER, PRIMARY KEY (id))",
+    "CREATE TABLE spoiler (id INTEGER NOT NULL, found_at DATETIME, url VARCHAR, source VARCHAR, source_id VARCHAR, "
+    "file_type VARCHAR, image_id INTEGER, set_code VARCHAR, PRIMARY KEY (id), "
+    "FOREIGN KEY(image_id) REFERENCES image (id), FOREIGN KEY(set_code) REFERENCES 'set' (code))",
+]
+
+
+def test_migrate_baseline_database(engine):
+    with engine.begin() as connection:
+        for statement in baseline_schema:
+            connection.execute(statement)
+        connection.execute("INSERT INTO image (id, location, conf) VALUES (1, 'https://example.com/card.jpg', 12)")
+        connection.execute("INSERT INTO spoiler (id, source, image_id) VALUES (1, 'Reddit', 1)")
+
+    model.migrate()
+    # Safe to run on every start
+    model.migrate()
+
+    inspector = inspect(engine)
+    for table in model.Base.metadata.sorted_tables:
+        columns = {c["name"] for c in inspector.get_columns(table.name)}
+        assert columns == {c.name for c in table.columns}, table.name
+        indexes = {i["name"] for i in inspector.get_indexes(table.name)}
+        assert {i.name for i in table.indexes} <= indexes, table.name
+    with engine.connect() as connection:
+        rows = connection.execute("SELECT id, location, conf, phash FROM image").fetchall()
+        spoilers = connection.execute("SELECT id, image_id, pending FROM spoiler").fetchall()
+    assert [tuple(row) for row in rows] == [(1, "https://example.com/card.jpg", 12, None)]
+    assert [tuple(row) for row in spoilers] == [(1, 1, None)]
+
+
+def test_schema_compiles_for_postgresql():
+    dialect = postgresql.dialect()
+    for table in model.Base.metadata.sorted_tables:
+        ddl = str(CreateTable(table).compile(dialect=dialect))
+        assert "BLOB" not in ddl, table.name
+        for index in table.indexes:
+            CreateIndex(index).compile(dialect=dialect)
+    assert "descr BYTEA" in str(CreateTable(model.Image.__table__).compile(dialect=dialect))
+
+
+def test_claim_items_skips_items_of_other_workers(db):
+    assert claim_items(SpoilerSource.REDDIT, ["a", "b"], worker="w1") == ["a", "b"]
+    assert claim_items(SpoilerSource.REDDIT, ["a", "b", "c"], worker="w2") == ["c"]
+    # Same keys from another source are other items
+    assert claim_items(SpoilerSource.SCRYFALL, ["a"], worker="w2") == ["a"]
+    items = model.session_factory().query(CrawlItem).filter(CrawlItem.source == SpoilerSource.REDDIT.value)
+    assert {i.key: i.worker for i in items} == {"a": "w1", "b": "w1", "c": "w2"}
+
+
+def test_claim_items_takes_over_stale_claims(db):
+    assert claim_items(SpoilerSource.MYTHICSPOILER, ["a", "b"], worker="w1") == ["a", "b"]
+    finish_items(SpoilerSource.MYTHICSPOILER, ["a"])
+    assert claim_items(SpoilerSource.MYTHICSPOILER, ["a", "b"], worker="w2") == []
+    # w1 never finished b, done items are never claimed again
+    assert claim_items(SpoilerSource.MYTHICSPOILER, ["a", "b"], worker="w2", timeout=timedelta(0)) == ["b"]
+    item = model.session_factory().query(CrawlItem).filter(CrawlItem.key == "b").one()
+    assert (item.worker, item.status) == ("w2", CrawlStatus.CLAIMED.value)
+
+
+def test_interleaved_claims_claim_each_item_once(db, monkeypatch):
+    # Both workers read the item as claimable before any of them updates it
+    barrier = threading.Barrier(2, timeout=5)
+    read_candidates = model.claim_candidates
+
+    def claim_candidates(*args):
+        candidates = read_candidates(*args)
+        barrier.wait()
+        return candidates
+
+    monkeypatch.setattr(model, "claim_candidates", claim_candidates)
+    results = {}
+
+    def claim(worker):
+        results[worker] = claim_items(SpoilerSource.REDDIT, ["k"], worker=worker)
+
+    threads = [threading.Thread(target=claim, args=(worker,)) for worker in ("w1", "w2")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results.values()) == [[], ["k"]]
+    item = model.session_factory().query(CrawlItem).one()
+    assert item.worker == next(worker for worker, keys in results.items() if keys)
+
+
+def test_crawl_item_is_unique_by_source_and_key(db):
+    local_session = model.session_factory()
+    local_session.add(CrawlItem(source=SpoilerSource.REDDIT.value, key="a"))
+    local_session.commit()
+    local_session.add(CrawlItem(source=SpoilerSource.REDDIT.value, key="a"))
+    with pytest.raises(IntegrityError):
+        local_session.commit()
+    local_session.rollback()
+    local_session.close()
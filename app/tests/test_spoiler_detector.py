@@ -0,0 +1,50 @@
+import numpy as np
+from model import Image
+from spoiler_detector import DescriptorIndex, SpoilerDetector
+
+
+def histogram(*weights):
+    descr = np.zeros(16, dtype=np.float32)
+    descr[:len(weights)] = weights
+    return descr / descr.sum()
+
+
+def crop(name, descr, conf=0.9, size=100):
+    image = Image(location=name, descr=descr)
+    image.detection_conf = conf
+    image.cv_array = np.zeros((size, size, 3), dtype=np.uint8)
+    return image
+
+
+def test_remove_duplicates_keeps_best_crop_of_each_pair_in_initial_order():
+    images = [crop("a", histogram(0, 0, 0, 0, 5, 1, 1), conf=0.7),
+              crop("b", histogram(0, 0, 0, 0, 0, 0, 0, 5, 1)),
+              crop("a better", histogram(0, 0, 0, 0, 5, 1.2, 1), conf=0.95),
+              crop("c", histogram(*[0] * 12, 1, 5))]
+    kept = SpoilerDetector.remove_duplicates(images, confidence=30)
+    assert [i.location for i in kept] == ["b", "a better", "c"]
+
+
+def test_remove_duplicates_joins_chained_clusters():
+    start, end = histogram(6, 1, 1, 1), histogram(1, 1, 1, 6)
+    # Start and end are too far apart, both are near the middle one
+    images = [crop("start", start, conf=0.8),
+              crop("end", end, conf=0.8, size=200),
+              crop("middle", (start + end) / 2, conf=0.6)]
+    kept = SpoilerDetector.remove_duplicates(images, confidence=30)
+    # Same confidence, the largest crop wins
+    assert [i.location for i in kept] == ["end"]
+
+
+def test_remove_duplicates_of_single_image():
+    image = crop("a", histogram(1, 2))
+    assert SpoilerDetector.remove_duplicates([image], confidence=30) == [image]
+
+
+def test_index_query_returns_closest_keys():
+    index = DescriptorIndex()
+    for key, descr in enumerate([histogram(5, 1), histogram(1, 5), histogram(5, 1.2), histogram(0, 0, 1)]):
+        index.add(key, descr)
+    assert [key for distance, key in index.query(histogram(5, 1), k=2)] == [0, 2]
+    assert [key for distance, key in index.query(histogram(5, 1), exclude={0})] == [2]
+    assert index.query(histogram(5, 1), exclude={0, 1, 2, 3}) == []
@@ -1,6 +1,17 @@
+import io
+import os
+import time
+import uuid
+import random
+import tarfile
+import itertools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
+import config
 import im_utils
+import metrics
 
 
 class Yolo:
@@ -11,8 +22,16 @@ class Yolo:
         layer_names = self.net.getLayerNames()
         self.output_layers = [layer_names[i[0] - 1] for i in self.net.getUnconnectedOutLayers()]
 
+    @metrics.timed("yolo")
     def get_detected_objects(self, img_path, conf_thresh=0.6, ratio_thresh=0.05, show=False):
-        if im_utils.is_url(img_path):
+        """
+        Detect cards on an image
+        :param img_path: open_cv image array, url or path
+        :return: list of tuple (card crop, confidence, crop box relative to the image as (x1, y1, x2, y2))
+        """
+        if isinstance(img_path, np.ndarray):
+            real_img = img_path
+        elif im_utils.is_url(img_path):
             real_img = im_utils.imread_url(img_path, flags=1)
         else:
             real_img = cv2.imread(img_path)
@@ -74,7 +93,9 @@ class Yolo:
                 n_x2 = int(x * r)
                 n_h = int(h * r)
                 n_w = int(w * r)
-                detected_objects.append((real_img[n_y:n_y2 + n_h, n_x:n_x2 + n_w], confidences[i]))
+                real_h, real_w = real_img.shape[:2]
+                box = (n_x / real_w, n_y / real_h, min(n_x2 + n_w, real_w) / real_w, min(n_y2 + n_h, real_h) / real_h)
+                detected_objects.append((real_img[n_y:n_y2 + n_h, n_x:n_x2 + n_w], confidences[i], box))
 
                 if show:
                     # Drawing
@@ -90,55 +111,105 @@ class Yolo:
         return detected_objects
 
 
-if __name__ == "__main__":
-    # Generate yolo dataset for training
+def get_card_pool(frame, size):
+    """
+    Image urls of the newest cards with this frame, closest to freshly revealed ones
+    :return: list of tuple (png image url, art crop url)
+    """
     import scryfall
-    import config
-    import random
+    pool = []
+    for card in itertools.islice(scryfall.iter_search(order="released", frame=frame), size):
+        png = scryfall.get_image_urls(card, size="png")
+        art_crop = scryfall.get_image_urls(card, size="art_crop")
+        if png and art_crop:
+            pool.append((png[0], art_crop[0]))
+    return pool
+
+
+def generate_sample(task):
+    """
+    Compose one training image from cached card images, run in worker processes
+    :param task: tuple (random seed, background url, card urls, cache directory)
+    :return: tuple (name, jpeg bytes, yolo label text), None if images are missing
+    """
+    seed, background_url, card_urls, cache_dir = task
+    random.seed(seed)
+    background = im_utils.imread_cached(background_url, cache_dir, cv2.IMREAD_COLOR)
+    images = [im for im in (im_utils.imread_cached(url, cache_dir) for url in card_urls)
+              if im is not None and im.shape[0]]
+    if background is None or not images:
+        return None
+    image, positions = im_utils.overlay_images(background, images)
+    ok, buffer = cv2.imencode(".jpg", image)
+    return uuid.UUID(int=random.getrandbits(128)).hex, buffer.tobytes(), im_utils.get_yolo_label(0, positions)
+
+
+def add_to_tar(tar, name, content):
+    info = tarfile.TarInfo(name)
+    info.size = len(content)
+    info.mtime = time.time()
+    tar.addfile(info, io.BytesIO(content))
+
+
+def build_dataset(output, samples, cache_dir, workers=None, extended_art_ratio=0.4, pool_size=2000,
+                  min_cards=2, max_cards=5, seed=None):
+    """
+    Generate yolo training images of several cards on the art of another one, in a tar.gz archive
+    :param samples: number of images
+    :param cache_dir: card images are downloaded once there and reused by all images
+    :param workers: number of processes composing images, number of cpus if None
+    :param extended_art_ratio: part of images made of extended art cards, others have the regular frame
+    :param pool_size: number of cards fetched for each frame
+    :return: number of images written
+    """
     import tqdm
-    import os
-    # The population of images matters
-    # we need card as close as possible of freshly revealed one
-    # -> We generate images with only card with the new MTG frame
-    regular_image_number = 3
-    extended_art_image_number = 2
-    min_cards_per_images = 2
-    max_cards_per_images = 5
-    
-    # Create generated image directory if not exists
-    directory = os.path.join(config.src_dir, 'yolo', 'images')
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-        print(f"Create images directory at {directory}")
-
-    # Create classes file for yolo training
-    classes = "\n".join(config.classes)
-    with open(os.path.join(directory, "classes.txt"), "w") as f:
-        f.write(classes)
-
-    # Generate extended art card images
-    print("Fetch extended art cards on https://scryfall.com/. This may take a while...")
-    cards = scryfall.search(frame="extendedart")
-    tq = tqdm.tqdm(range(extended_art_image_number))
-    tq.set_description(f"Step 1/3: Extended art card image generation")
-    for n in tq:
-        random.shuffle(cards)
-        im_num = random.randrange(min_cards_per_images, max_cards_per_images+1)
-        im_utils.generate_yolo_image(directory, cards[0:im_num])
-
-    # Generate regular card images
-    print("Fetch regular art cards on https://scryfall.com/. This may take a while...")
-    cards = scryfall.search(frame="2015")
-    tq = tqdm.tqdm(range(extended_art_image_number))
-    tq.set_description(f"Step 2/3: Regular art card image generation")
-    for n in tq:
-        random.shuffle(cards)
-        im_num = random.randrange(min_cards_per_images, max_cards_per_images+1)
-        im_utils.generate_yolo_image(directory, cards[0:im_num])
-    
-    print("Step 3/3: Archive generation, wait for Success message...")
-    # Create archive for google collab purposes
-    im_utils.create_archive(os.path.join(config.src_dir, 'yolo'), "images")
-    print(f"Successfully generated archive {os.path.join(config.src_dir, 'yolo', 'images.tar.gz')}")
+    rng = random.Random(seed)
+    os.makedirs(cache_dir, exist_ok=True)
+    print("Fetch extended art and regular cards on https://scryfall.com/...")
+    pools = [get_card_pool("extendedart", pool_size), get_card_pool("2015", pool_size)]
+    if not all(len(pool) > max_cards for pool in pools):
+        print("Not enough cards found on scryfall")
+        return 0
+    tasks = []
+    for n in range(samples):
+        pool = pools[0] if rng.random() < extended_art_ratio else pools[1]
+        cards = rng.sample(pool, rng.randint(min_cards, max_cards) + 1)
+        tasks.append((rng.getrandbits(64), cards[0][1], [png for png, art_crop in cards[1:]], cache_dir))
+
+    # Download each source image once, the composition then only reads the cache
+    urls = {task[1] for task in tasks} | {url for task in tasks for url in task[2]}
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(tqdm.tqdm(executor.map(lambda url: im_utils.download_cached(url, cache_dir), urls), total=len(urls),
+                       desc="Step 1/2: Card image download"))
+
+    # Stream images and labels into the archive as workers produce them, jpeg doesn't compress much
+    written = 0
+    with multiprocessing.Pool(workers) as pool, tarfile.open(output, "w:gz", compresslevel=1) as tar:
+        add_to_tar(tar, "classes.txt", "\n".join(config.classes).encode())
+        results = pool.imap_unordered(generate_sample, tasks, chunksize=8)
+        for result in tqdm.tqdm(results, total=samples, desc="Step 2/2: Image generation"):
+            if result:
+                name, image, label = result
+                add_to_tar(tar, f"{name}.jpg", image)
+                add_to_tar(tar, f"{name}.txt", label.encode())
+                written += 1
+    return written
 
 
+if __name__ == "__main__":
+    # Generate yolo dataset for training
+    import argparse
+    parser = argparse.ArgumentParser(description="Generate the yolo training dataset")
+    parser.add_argument("--samples", type=int, default=5, help="number of generated images")
+    parser.add_argument("--workers", type=int, help="number of processes, number of cpus by default")
+    parser.add_argument("--extended-art-ratio", type=float, default=0.4,
+                        help="part of images made of extended art cards")
+    parser.add_argument("--pool", type=int, default=2000, help="number of cards fetched for each frame")
+    parser.add_argument("--cache", default=os.path.join(config.src_dir, 'yolo', 'cache'),
+                        help="card image cache directory")
+    parser.add_argument("--output", default=os.path.join(config.src_dir, 'yolo', 'images.tar.gz'))
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+    count = build_dataset(args.output, args.samples, args.cache, workers=args.workers,
+                          extended_art_ratio=args.extended_art_ratio, pool_size=args.pool, seed=args.seed)
+    print(f"Successfully generated archive {args.output} with {count} images")